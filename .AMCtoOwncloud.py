@@ -22,14 +22,32 @@ import csv
 import re
 import owncloud
 import getpass
-import requests  # for owncloud behind SSO only
+import requests
 import lxml.html  # for owncloud behind SSO only
 import math
 import datetime
+import fnmatch
+import contextlib
+import sqlite3
+import hashlib
+import argparse
+import configparser
+import json
+import time
+import uuid
+import random
+import email.utils
+import email.message
+import smtplib
+import ssl
 import shutil
+import subprocess
+from urllib import parse
+import xml.etree.ElementTree as ET
+import threading
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
 from pathlib import Path
-import pyshorteners
-from pyshorteners import Shortener
 
 ######### Implementation
 
@@ -67,6 +85,7 @@ class Student:
         self.owncloud = owncloud
         self.quiz = quiz
         self.link = link
+        self.shortlink = shortlink
 
     def __str__(self):
         """To display Student attributes using print()"""
@@ -81,55 +100,1028 @@ class Student:
                f" {self.email}")
 
 
+class Metrics:
+    """Metrics object"""
+
+    def __init__(self):
+        """Record durations of run phases and of remote calls.
+
+        - phases: total duration of each phase (file scan, csv load, login...)
+        - calls: count, errors, bytes and durations of each remote call
+        (mkdir, put_file, get_shares...), for percentiles
+        """
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.calls = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the duration of the with block to phase name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + duration
+
+    def timed_iter(self, name, iterable):
+        """Yield from iterable, adding the time spent waiting to phase name"""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextlib.contextmanager
+    def call(self, name, nbytes=0):
+        """Record a remote call (duration, bytes sent, error if raised).
+
+        Yield a dict: set its "response" to the requests.Response returned
+        by the call, so that an error status (>= 400) counts as an error.
+        """
+        start = time.perf_counter()
+        result = {"response": None}
+        error = False
+        try:
+            yield result
+            error = (isinstance(result["response"], requests.Response)
+                     and result["response"].status_code >= 400)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                call = self.calls.setdefault(name, {"count": 0, "errors": 0,
+                                                    "bytes": 0,
+                                                    "durations": []})
+                call["count"] += 1
+                call["errors"] += error
+                call["bytes"] += nbytes
+                call["durations"].append(duration)
+
+    @staticmethod
+    def percentile(durations, q):
+        """Nearest-rank percentile (q between 0 and 100)"""
+        durations = sorted(durations)
+        return durations[max(0, math.ceil(q / 100 * len(durations)) - 1)]
+
+    def as_dict(self):
+        """Phases and calls (with percentiles instead of durations)"""
+        with self._lock:
+            calls = {name: {"count": call["count"],
+                            "errors": call["errors"],
+                            "bytes": call["bytes"],
+                            "seconds": sum(call["durations"]),
+                            "p50": self.percentile(call["durations"], 50),
+                            "p90": self.percentile(call["durations"], 90),
+                            "p99": self.percentile(call["durations"], 99),
+                            "max": max(call["durations"])}
+                     for name, call in self.calls.items()}
+            return {"phases": dict(self.phases), "calls": calls}
+
+    def summary(self):
+        """Summary table (as a string)"""
+        metrics = self.as_dict()
+        lines = [f"{'Phase':20} {'Seconds':>9}"]
+        for name, seconds in metrics["phases"].items():
+            lines.append(f"{name:20} {seconds:9.2f}")
+        lines.append(f"\n{'Remote call':20} {'Count':>6} {'Errors':>6}"
+                     f" {'MB':>8} {'Seconds':>9} {'p50 ms':>8}"
+                     f" {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for name, call in metrics["calls"].items():
+            lines.append(f"{name:20} {call['count']:6d} {call['errors']:6d}"
+                         f" {call['bytes'] / 1e6:8.1f}"
+                         f" {call['seconds']:9.2f}"
+                         f" {call['p50'] * 1000:8.0f}"
+                         f" {call['p90'] * 1000:8.0f}"
+                         f" {call['p99'] * 1000:8.0f}"
+                         f" {call['max'] * 1000:8.0f}")
+        return "\n".join(lines)
+
+    def write_json(self, json_filepath):
+        with open(json_filepath, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def write_prometheus(self, prometheus_filepath):
+        """Write a Prometheus textfile (for node_exporter textfile collector)"""
+        metrics = self.as_dict()
+        lines = ["# HELP amctoowncloud_phase_seconds Duration of a phase.",
+                 "# TYPE amctoowncloud_phase_seconds gauge"]
+        for name, seconds in metrics["phases"].items():
+            lines.append(f'amctoowncloud_phase_seconds{{phase="{name}"}}'
+                         f' {seconds:.6f}')
+        lines += ["# HELP amctoowncloud_call_seconds Duration of remote calls.",
+                  "# TYPE amctoowncloud_call_seconds summary"]
+        for name, call in metrics["calls"].items():
+            for quantile, key in (("0.5", "p50"), ("0.9", "p90"),
+                                  ("0.99", "p99")):
+                lines.append(f'amctoowncloud_call_seconds{{call="{name}",'
+                             f'quantile="{quantile}"}} {call[key]:.6f}')
+            lines.append(f'amctoowncloud_call_seconds_sum{{call="{name}"}}'
+                         f' {call["seconds"]:.6f}')
+            lines.append(f'amctoowncloud_call_seconds_count{{call="{name}"}}'
+                         f' {call["count"]}')
+        for metric, key in (("call_errors_total", "errors"),
+                            ("call_bytes_total", "bytes")):
+            lines.append(f"# TYPE amctoowncloud_{metric} counter")
+            for name, call in metrics["calls"].items():
+                lines.append(f'amctoowncloud_{metric}{{call="{name}"}}'
+                             f' {call[key]}')
+        tmp_filepath = f"{prometheus_filepath}.tmp"
+        with open(tmp_filepath, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_filepath, prometheus_filepath)
+
+
+class RetryPolicy:
+    """RetryPolicy object"""
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    BACK_PRESSURE_STATUS = (429, 503)
+
+    def __init__(self, retries=5, backoff=1.0, max_backoff=60.0,
+                 max_in_flight=1):
+        """Retry remote calls and adapt concurrency to server back-pressure.
+
+        - Failed calls (connection errors, 429 and 5xx answers) are retried
+        up to retries times, after an exponential backoff with jitter
+        (random between 0 and backoff * 2^attempt) or after the delay
+        asked by the server (Retry-After header)
+        - At most limit calls are in flight (AIMD): limit is halved when the
+        server pushes back (429, 503) and grows by one after limit
+        successful calls, up to max_in_flight
+        - Calls which are not idempotent (creating shares) are only retried
+        when the server refused them (429, 503)
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_in_flight = max_in_flight
+        self.limit = max_in_flight
+        self.retried = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._random = random.Random()
+
+    def call(self, function, *args, idempotent=True, **kwargs):
+        """Call function(*args, **kwargs), retrying it if necessary"""
+        for attempt in range(self.retries + 1):
+            self._acquire()
+            error = status = response = None
+            try:
+                try:
+                    result = function(*args, **kwargs)
+                except owncloud.ResponseError as e:
+                    error, status = e, e.status_code
+                    response = getattr(e, "res", None)
+                except requests.RequestException as e:
+                    error, response = e, e.response
+                else:
+                    response = result
+                if status is None and isinstance(response, requests.Response):
+                    status = response.status_code
+            finally:
+                # always free the slot, other exceptions are not retried
+                self._release(
+                        back_pressure=status in self.BACK_PRESSURE_STATUS)
+
+            retry = (status in self.BACK_PRESSURE_STATUS or
+                     (idempotent and (status in self.RETRY_STATUS or
+                                      (error is not None and status is None))))
+            if not retry or attempt == self.retries:
+                if error is not None:
+                    raise error
+                return result
+            with self._condition:
+                self.retried += 1
+            time.sleep(self._delay(attempt, response))
+
+    def _delay(self, attempt, response):
+        """Seconds to wait before the next attempt"""
+        retry_after = (response.headers.get("Retry-After")
+                       if isinstance(response, requests.Response) else None)
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:  # HTTP date
+                date = email.utils.parsedate_to_datetime(retry_after)
+                return min(max(0, date.timestamp() - time.time()),
+                           self.max_backoff)
+        return self._random.uniform(0, min(self.max_backoff,
+                                           self.backoff * 2 ** attempt))
+
+    def _acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def _release(self, back_pressure):
+        with self._condition:
+            self._in_flight -= 1
+            if back_pressure:
+                self.limit = max(1, self.limit / 2)
+            else:
+                self.limit = min(self.max_in_flight,
+                                 self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class HostBasicAuth(requests.auth.HTTPBasicAuth):
+    """Basic authentication only sent to one host"""
+
+    def __init__(self, url, username, password):
+        super().__init__(username, password)
+        self.host = parse.urlparse(url).netloc
+
+    def __call__(self, r):
+        if parse.urlparse(r.url).netloc == self.host:
+            return super().__call__(r)
+        return r
+
+
+class Transport:
+    """Transport object"""
+
+    def __init__(self, pool_size=10):
+        """One pooled keep-alive HTTP session for every remote call.
+
+        WebDAV and OCS requests (pyocclient), chunked uploads and the link
+        shortener share this session. Up to pool_size connections per host
+        are kept alive and reused (pool_size should be >= max_workers).
+        """
+        self.session = requests.session()
+        self._adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+
+    def stats(self):
+        """Connection reuse statistics (all hosts together).
+
+        - requests: number of requests sent
+        - connections: number of new connections
+        - tls_handshakes: number of new HTTPS connections
+        - reused: number of requests sent on an existing connection
+        """
+        stats = {"requests": 0, "connections": 0, "tls_handshakes": 0}
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+            if pool.scheme == "https":
+                stats["tls_handshakes"] += pool.num_connections
+        stats["reused"] = stats["requests"] - stats["connections"]
+        return stats
+
+
+class RateLimiter:
+    """RateLimiter object"""
+
+    def __init__(self, per_second=1.0):
+        """Space out calls by 1/per_second seconds, shared by all threads"""
+        self._interval = 1 / per_second
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        """Sleep until the next call is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def read_json_lines(filepath):
+    """Yield the records of a JSON lines file (one JSON object per line).
+
+    A last line cut by a crash is skipped.
+    """
+    with open(filepath) as json_file:
+        for line in json_file:
+            try:
+                yield json.loads(line)
+            except ValueError:  # line cut by a crash
+                continue
+
+
+class UploadManifest:
+    """UploadManifest object"""
+
+    def __init__(self, manifest_filepath):
+        """Open (or create) a SQLite manifest of the files already uploaded.
+
+        One row per remote file with:
+        - student number
+        - local path, size, mtime and content hash (sha256)
+        - remote path and etag
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(manifest_filepath),
+                                   check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                         " remote_path TEXT PRIMARY KEY,"
+                         " number TEXT,"
+                         " local_path TEXT,"
+                         " size INTEGER,"
+                         " mtime REAL,"
+                         " sha256 TEXT,"
+                         " etag TEXT)")
+        self._db.commit()
+
+    @staticmethod
+    def file_hash(local_path):
+        """sha256 of a local file, read by blocks"""
+        sha256 = hashlib.sha256()
+        with open(local_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def is_uploaded(self, local_path, remote_path, remote_tree=None,
+                    listed_folders=()):
+        """Return True if local_path has already been sent to remote_path.
+
+        The local file is unchanged if size and mtime are the same
+        (or, if only mtime changed, if the content hash is the same).
+        If a remote_tree snapshot is given, the remote file must still
+        have the etag recorded at upload time (files recorded without etag
+        by older versions take the etag of the snapshot). A remote file
+        missing from the snapshot is only taken as deleted if its folder
+        is in listed_folders (folders whose whole content was listed).
+        """
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime, sha256, etag"
+                                   " FROM uploads WHERE remote_path = ?",
+                                   (remote_path,)).fetchone()
+        if row is None:
+            return False
+        size, mtime, sha256, etag = row
+        if remote_tree is not None:
+            key = AMCtoOwncloud._normalize_remote_path(remote_path)
+            if key in remote_tree:
+                if etag is not None and etag != remote_tree[key]:
+                    return False
+                etag = remote_tree[key]
+            elif (key.rsplit("/", 1)[0] or "/") in listed_folders:
+                return False
+        stat = os.stat(local_path)
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime != mtime and self.file_hash(local_path) != sha256:
+            return False
+        with self._lock:
+            self._db.execute("UPDATE uploads SET local_path = ?, mtime = ?,"
+                             " etag = ? WHERE remote_path = ?",
+                             (local_path, stat.st_mtime, etag, remote_path))
+            self._db.commit()
+        return True
+
+    def record(self, number, local_path, remote_path, etag=None):
+        """Save (or replace) the upload of local_path to remote_path"""
+        stat = os.stat(local_path)
+        sha256 = self.file_hash(local_path)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO uploads"
+                             " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (remote_path, number, local_path, stat.st_size,
+                              stat.st_mtime, sha256, etag))
+            self._db.commit()
+
+
+class RunJournal:
+    """RunJournal object"""
+
+    def __init__(self, journal_filepath, resume=False):
+        """Open an append-only journal of the steps completed per student.
+
+        Each line is a JSON record: {"number": ..., "step": ..., "value": ...}
+        with step among "folder", "upload", "user_share", "link", "shortlink".
+        The first line stores the run parameters ({"run": {...}}).
+        If resume=True, the previous journal is replayed and continued,
+        otherwise it is discarded.
+        Create a steps attribute (key = number, value = {step: value}).
+        """
+        self._lock = threading.Lock()
+        self._journal_filepath = journal_filepath
+        self.run = {}
+        self.steps = {}
+        if resume and os.path.exists(journal_filepath):
+            for record in read_json_lines(journal_filepath):
+                if "run" in record:
+                    self.run = record["run"]
+                else:
+                    self.steps.setdefault(record["number"], {})[
+                                        record["step"]] = record["value"]
+        self._file = open(journal_filepath, "a" if resume else "w")
+
+    def start(self, **run):
+        """Save the run parameters (only for a new journal).
+
+        A resumed journal of a run with other parameters (e.g. another
+        remote folder) is discarded, its steps don't apply to this run:
+        return False in this case.
+        """
+        kept = self.run in ({}, run)
+        if not kept:
+            self._file.close()
+            self._file = open(self._journal_filepath, "w")
+            self.steps = {}
+        if self.run != run:
+            self.run = run
+            self._write({"run": run})
+        return kept
+
+    def done(self, number, step):
+        """True if step has already been completed for this student"""
+        return step in self.steps.get(number, {})
+
+    def record(self, number, step, value=None):
+        """Save a completed step on disk before going further"""
+        with self._lock:
+            self.steps.setdefault(number, {})[step] = value
+        self._write({"number": number, "step": step, "value": value})
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class LinkShortener:
+    """LinkShortener object"""
+
+    def __init__(self, cache_filepath=None, links=None,
+                 api_url="https://tinyurl.com/api-create.php",
+                 requests_per_second=1.0, retries=5, session=None,
+                 metrics=None):
+        """Shorten links with tinyurl.com, each link only once ever.
+
+        - Known short links come from links (pairs of link and shortlink,
+        from the .csv file) and from a JSON cache file (cache_filepath)
+        - Unknown links are shortened through one shared HTTP session,
+        with at most requests_per_second requests and exponential backoff
+        between retries (1s, 2s, 4s...)
+        - api_url can point to a local stand-in service for testing
+        - session can be shared with other remote calls (see Transport)
+        - requests are recorded as "shorten" calls in metrics (see Metrics)
+        """
+        self._cache_filepath = cache_filepath
+        self._api_url = api_url
+        self._rate_limiter = RateLimiter(requests_per_second)
+        self._retries = retries
+        self._session = session or requests.session()
+        self._metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._cache = {}
+        if cache_filepath and os.path.exists(cache_filepath):
+            with open(cache_filepath) as cache_file:
+                self._cache.update(json.load(cache_file))
+        for link, shortlink in links or []:
+            if link and shortlink:
+                self._cache.setdefault(link, shortlink)
+
+    def short(self, link):
+        """Return the short link (from cache or from the shortener)"""
+        if link in self._cache:
+            return self._cache[link]
+        for attempt in range(self._retries):
+            self._rate_limiter.wait()
+            try:
+                with self._metrics.call("shorten") as call:
+                    res = call["response"] = self._session.get(
+                                                self._api_url,
+                                                params={"url": link},
+                                                timeout=30)
+                if res.status_code == 200 and res.text.startswith("http"):
+                    break
+            except requests.RequestException:
+                pass
+            if attempt < self._retries - 1:
+                time.sleep(2 ** attempt)
+        else:
+            raise RuntimeError(f"Link couldn't be shortened"
+                               f" after {self._retries} tries")
+        with self._lock:
+            self._cache[link] = res.text.strip()
+            self._save()
+        return self._cache[link]
+
+    def _save(self):
+        """Write the cache file (temporary file renamed, never half written)"""
+        if not self._cache_filepath:
+            return
+        tmp_filepath = f"{self._cache_filepath}.tmp"
+        with open(tmp_filepath, "w") as cache_file:
+            json.dump(self._cache, cache_file, indent=0)
+        os.replace(tmp_filepath, self._cache_filepath)
+
+
+class PdfCompressor:
+    """PdfCompressor object"""
+
+    QUALITIES = ("screen", "ebook", "printer", "prepress")
+
+    def __init__(self, cache_folder, dpi=150, quality="ebook",
+                 max_workers=None, ghostscript=None):
+        """Make scanned .pdf papers smaller with ghostscript before upload.
+
+        - Images are downsampled to dpi and recompressed with a ghostscript
+        quality preset (quality: "screen", "ebook", "printer", "prepress")
+        - Up to max_workers ghostscript processes run at the same time
+        (default: number of CPUs)
+        - Compressed files are cached in cache_folder by content hash
+        (sha256) and settings, so an unchanged paper is compressed once
+        - The original file is kept if it is not a .pdf file, if the
+        compressed file is not smaller or if ghostscript fails
+        """
+        if quality not in self.QUALITIES:
+            raise ValueError(f"quality must be one of {self.QUALITIES}")
+        self._cache_folder = Path(cache_folder)
+        self._dpi = dpi
+        self._quality = quality
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._ghostscript = ghostscript or shutil.which("gs")
+        self.stats = {"compressed_files": 0, "kept_files": 0,
+                      "original_bytes": 0, "compressed_bytes": 0}
+        self._lock = threading.Lock()
+
+    def compress_all(self, local_paths):
+        """Return a dict: local path -> path of the file to upload"""
+        if self._ghostscript is None:
+            print("ERROR: ghostscript (gs) not found,"
+                  " papers are sent without compression")
+            return {local_path: local_path for local_path in local_paths}
+        self._cache_folder.mkdir(exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            return dict(zip(local_paths,
+                            executor.map(self.compress, local_paths)))
+
+    def compress(self, local_path):
+        """Return the compressed copy of local_path, or local_path itself"""
+        if not local_path.lower().endswith(".pdf"):
+            return local_path
+        key = (f"{UploadManifest.file_hash(local_path)}"
+               f"-{self._dpi}-{self._quality}")
+        compressed_path = self._cache_folder / (key + ".pdf")
+        kept_path = self._cache_folder / (key + ".kept")  # no gain last time
+        if not (compressed_path.exists() or kept_path.exists()):
+            tmp_path = self._cache_folder / (key + ".tmp")
+            try:
+                subprocess.run([self._ghostscript, "-q", "-dBATCH",
+                                "-dNOPAUSE", "-dSAFER", "-sDEVICE=pdfwrite",
+                                f"-dPDFSETTINGS=/{self._quality}",
+                                "-dDownsampleColorImages=true",
+                                "-dDownsampleGrayImages=true",
+                                "-dDownsampleMonoImages=true",
+                                f"-dColorImageResolution={self._dpi}",
+                                f"-dGrayImageResolution={self._dpi}",
+                                f"-dMonoImageResolution={self._dpi}",
+                                f"-sOutputFile={tmp_path}", local_path],
+                               check=True, capture_output=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f'ERROR: "{local_path}" couldn\'t be compressed\n{e}')
+                if tmp_path.exists():
+                    tmp_path.unlink()
+                return local_path
+            if tmp_path.stat().st_size < os.path.getsize(local_path):
+                os.replace(tmp_path, compressed_path)
+            else:
+                tmp_path.unlink()
+                kept_path.touch()
+        original_size = os.path.getsize(local_path)
+        if compressed_path.exists():
+            upload_path = str(compressed_path)
+        else:
+            upload_path = local_path
+        with self._lock:
+            self.stats["original_bytes"] += original_size
+            self.stats["compressed_bytes"] += os.path.getsize(upload_path)
+            if upload_path == local_path:
+                self.stats["kept_files"] += 1
+            else:
+                self.stats["compressed_files"] += 1
+        return upload_path
+
+
+def qr_matrix(link):
+    """QR code of link as rows of booleans (True = dark module).
+
+    Module level function, so that it can run in a process pool.
+    """
+    from reportlab.graphics.barcode import qrencoder
+    qr = qrencoder.QRCode(None, qrencoder.QRErrorCorrectLevel.M)
+    qr.addData(link)
+    qr.make()
+    size = qr.getModuleCount()
+    return [[qr.isDark(row, col) for col in range(size)]
+            for row in range(size)]
+
+
+class LetterWriter:
+    """LetterWriter object"""
+
+    GREETING = "Madame, Monsieur,"
+    BODY = ("Veuillez trouver ci-dessous un lien internet permettant"
+            " d'accéder aux évaluations en {subject} de votre enfant :")
+    QR_TEXT = ("Pour plus de simplicité, vous pouvez scanner le QR code"
+               " suivant :")
+    CLOSING = "Cordialement,"
+
+    def __init__(self, subject="Mathématiques", signature="R.G.",
+                 max_workers=None):
+        """Write information letters (one page per student) with reportlab.
+
+        Same letter as "information letters/InformationLetters.tex":
+        group, surname and name, link and QR code of the link.
+        QR codes (the slow part) are computed by a pool of max_workers
+        processes (default: number of CPUs), pages are then drawn in order.
+        """
+        self._subject = subject
+        self._signature = signature
+        self._max_workers = max_workers
+
+    @staticmethod
+    def select(students, groups=None):
+        """Students with a link, in the given groups (like the .tex filter)"""
+        return [student for student in students
+                if student.link and (not groups or student.group in groups)]
+
+    def write(self, students, pdf_filepath, per_group=False):
+        """Write the letters of students to pdf_filepath.
+
+        With per_group=True, one file per group is written instead:
+        "name-Group.pdf" next to pdf_filepath.
+        Return the list of files written.
+        """
+        if not students:
+            return []
+        with ProcessPoolExecutor(max_workers=self._max_workers) as executor:
+            matrices = list(executor.map(
+                                qr_matrix,
+                                [student.link for student in students],
+                                chunksize=8))
+
+        pdf_filepath = Path(pdf_filepath)
+        documents = {}
+        for student, matrix in zip(students, matrices):
+            if per_group:
+                filepath = pdf_filepath.with_name(
+                            f"{pdf_filepath.stem}-{student.group}.pdf")
+            else:
+                filepath = pdf_filepath
+            documents.setdefault(filepath, []).append((student, matrix))
+        for filepath, letters in documents.items():
+            self._write_document(filepath, letters)
+        return list(documents)
+
+    def _write_document(self, filepath, letters):
+        """Draw one page per (student, QR matrix) pair"""
+        from reportlab.lib.pagesizes import A4
+        from reportlab.lib.units import cm
+        from reportlab.lib.utils import simpleSplit
+        from reportlab.pdfgen import canvas
+
+        width, height = A4
+        margin = 2 * cm
+        text_width = width - 2 * margin
+        pdf = canvas.Canvas(str(filepath), pagesize=A4)
+        pdf.setTitle(filepath.stem)
+        for student, matrix in letters:
+            y = height - margin - 12
+            pdf.setFont("Helvetica-Bold", 12)
+            pdf.drawCentredString(width / 2, y, f"{student.group}    "
+                                  f"{student.surname}    {student.name}")
+            y -= 36
+            pdf.setFont("Helvetica", 12)
+            pdf.drawString(margin, y, self.GREETING)
+            y -= 30
+            for line in simpleSplit(self.BODY.format(subject=self._subject),
+                                    "Helvetica", 12, text_width):
+                pdf.drawString(margin, y, line)
+                y -= 16
+            y -= 14
+            font_size = 12
+            while (pdf.stringWidth(student.link, "Courier", font_size)
+                   > text_width and font_size > 6):
+                font_size -= 1
+            pdf.setFont("Courier", font_size)
+            pdf.drawCentredString(width / 2, y, student.link)
+            link_width = pdf.stringWidth(student.link, "Courier", font_size)
+            pdf.linkURL(student.link, ((width - link_width) / 2, y - 3,
+                                       (width + link_width) / 2,
+                                       y + font_size), relative=0)
+            y -= 34
+            pdf.setFont("Helvetica", 12)
+            for line in simpleSplit(self.QR_TEXT, "Helvetica", 12,
+                                    text_width):
+                pdf.drawString(margin, y, line)
+                y -= 16
+            # QR code: 4 cm wide, dark modules drawn as squares
+            module = 4 * cm / len(matrix)
+            x0, y0 = (width - 4 * cm) / 2, y - 4 * cm - 6
+            for row, modules in enumerate(matrix):
+                for col, dark in enumerate(modules):
+                    if dark:
+                        pdf.rect(x0 + col * module,
+                                 y0 + (len(matrix) - row - 1) * module,
+                                 module, module, stroke=0, fill=1)
+            y = y0 - 30
+            pdf.drawString(margin, y, self.CLOSING)
+            pdf.drawRightString(width - margin, y - 24, self._signature)
+            pdf.showPage()
+        pdf.save()
+
+
+class Mailer:
+    """Mailer object"""
+
+    SUBJECT_TEMPLATE = "Évaluations en {subject}"
+    TEMPLATE = ("Madame, Monsieur,\n\n"
+                "Veuillez trouver ci-dessous un lien internet permettant"
+                " d'accéder aux évaluations en {subject} de votre enfant"
+                " {name} {surname} ({group}) :\n\n"
+                "{link}\n\n"
+                "Cordialement,\n"
+                "{signature}\n")
+
+    def __init__(self, host, port=587, sender=None, username=None,
+                 password=None, security="starttls", sent_log_filepath=None,
+                 subject_template=SUBJECT_TEMPLATE, template=TEMPLATE,
+                 fields=None,
+                 messages_per_second=1.0, batch_size=50, pool_size=1,
+                 retries=3, metrics=None):
+        """Send links by e-mail through a few reused SMTP connections.
+
+        - security: "starttls" (port 587), "ssl" (port 465) or "none"
+        (e.g. a local SMTP sink, see benchmark/smtp_sink.py)
+        - subject_template and template are formatted with the student
+        attributes (name, surname, group, number, link...) and fields
+        (default: subject="Mathématiques", signature="R.G.")
+        - pool_size connections send batches of batch_size messages each
+        (a connection is opened again after each batch), with at most
+        messages_per_second messages for all connections
+        - every message sent is saved at once in sent_log_filepath (one
+        JSON line per message, with the share link and the URL sent), so
+        the same share is never sent twice to the same address, even as
+        a short link the second time
+        - messages are recorded as "smtp_send" calls in metrics
+        """
+        self._host = host
+        self._port = port
+        self._sender = sender or username
+        self._username = username
+        self._password = password
+        self._security = security
+        self._sent_log_filepath = sent_log_filepath
+        self._subject_template = subject_template
+        self._template = template
+        self._fields = {"subject": "Mathématiques", "signature": "R.G.",
+                        **(fields or {})}
+        self._rate_limiter = RateLimiter(messages_per_second)
+        self._batch_size = batch_size
+        self._pool_size = pool_size
+        self._retries = retries
+        self._metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._sent = set()  # (address, share link)
+        if sent_log_filepath and os.path.exists(sent_log_filepath):
+            for record in read_json_lines(sent_log_filepath):
+                self._sent.add((record["email"], record["link"]))
+
+    def send(self, students, use_shortlink=True):
+        """E-mail each student (with an e-mail and a link) their link.
+
+        The short link is sent if use_shortlink and if there is one.
+        Return stats: {"sent": ..., "already_sent": ..., "failed": ...}.
+        """
+        stats = {"sent": 0, "already_sent": 0, "failed": 0}
+        messages = []
+        for student in students:
+            link = (use_shortlink and student.shortlink) or student.link
+            if not (student.email and link):
+                continue
+            if (student.email, student.link) in self._sent:
+                stats["already_sent"] += 1
+                continue
+            messages.append((student, link))
+        batches = [messages[i:i + self._batch_size]
+                   for i in range(0, len(messages), self._batch_size)]
+        with (open(self._sent_log_filepath, "a") if self._sent_log_filepath
+              else contextlib.nullcontext()) as sent_log, \
+             ThreadPoolExecutor(max_workers=self._pool_size) as executor:
+            for sent, failed in executor.map(
+                                lambda batch: self._send_batch(batch,
+                                                               sent_log),
+                                batches):
+                stats["sent"] += sent
+                stats["failed"] += failed
+        return stats
+
+    def _send_batch(self, batch, sent_log):
+        """Send messages through one SMTP connection, return counts"""
+        sent = failed = 0
+        smtp = None
+        try:
+            for student, link in batch:
+                message = self._message(student, link)
+                for _ in range(self._retries + 1):
+                    self._rate_limiter.wait()
+                    try:
+                        if smtp is None:
+                            smtp = self._connect()
+                        with self._metrics.call("smtp_send"):
+                            smtp.send_message(message)
+                    except smtplib.SMTPServerDisconnected as e:
+                        error = e
+                        smtp = self._close(smtp)  # open a new one
+                    except smtplib.SMTPException as e:
+                        error = e  # message refused, connection still usable
+                        break
+                    except OSError as e:  # network error
+                        error = e
+                        smtp = self._close(smtp)
+                    else:
+                        error = None
+                        break
+                if error is None:
+                    self._record(student, link, sent_log)
+                    sent += 1
+                else:
+                    print(f'ERROR: e-mail to "{student.email}"'
+                          f" couldn't be sent\n{error}")
+                    failed += 1
+        finally:
+            self._close(smtp)
+        return sent, failed
+
+    @staticmethod
+    def _close(smtp):
+        """Quit (or at least close) an SMTP connection, return None"""
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+        return None
+
+    def _connect(self):
+        """Open (and log in) one SMTP connection"""
+        context = ssl.create_default_context()
+        if self._security == "ssl":
+            smtp = smtplib.SMTP_SSL(self._host, self._port, timeout=30,
+                                    context=context)
+        else:
+            smtp = smtplib.SMTP(self._host, self._port, timeout=30)
+            if self._security == "starttls":
+                smtp.starttls(context=context)
+        if self._username:
+            smtp.login(self._username, self._password)
+        return smtp
+
+    def _message(self, student, link):
+        """Message to student, from templates"""
+        fields = dict(vars(student), **self._fields)
+        fields["link"] = link
+        message = email.message.EmailMessage()
+        message["From"] = self._sender
+        message["To"] = student.email
+        message["Subject"] = self._subject_template.format(**fields)
+        message["Date"] = email.utils.formatdate(localtime=True)
+        message["Message-ID"] = email.utils.make_msgid()
+        message.set_content(self._template.format(**fields))
+        return message
+
+    def _record(self, student, link, sent_log):
+        """Save a sent message (link sent for student.link) on disk"""
+        with self._lock:
+            self._sent.add((student.email, student.link))
+            if sent_log is None:
+                return
+            sent_log.write(json.dumps({
+                    "email": student.email, "link": student.link,
+                    "sent": link,
+                    "date": datetime.datetime.now().isoformat(
+                                                    timespec="seconds")})
+                           + "\n")
+            sent_log.flush()
+            os.fsync(sent_log.fileno())
+
+
 class AMCtoOwncloud:
     """AMCtoOwncloud object"""
 
-    def __init__(self, list_of_paths=None, verbose=False):
+    def __init__(self, list_of_paths=None, verbose=False,
+                 recursive=False, include=None, exclude=None):
         """
-        Looks in folders (but not subfolders) and keeps files (not symlinks).
+        Looks in folders (and subfolders if recursive=True) for files
+        (not symlinks).
 
         If no path is provided, get paths from Nautilus file manager.
-        Create a _list_of_files attribute.
+        Files can be filtered on their names with lists of glob patterns,
+        e.g. include=["*.pdf"], exclude=["*-corrected*"].
+        Folders are scanned lazily while files are associated to students
+        (see _iter_files), _list_of_files keeps the files found so far.
+        Other files can be selected later in the same session (see
+        select_files and run_batch).
         """
         self._cloud_client = None
+        self._transport = None
+        self._username = None
         self._csvfile = None
         self._dict_of_students = None
         self._matched_students = None
+        self._remote_tree = None
+        self._share_index = None
         self._list_of_files = []
+        self._print_lock = threading.Lock()
+        self._metrics = Metrics()
+        self._retry_policy = RetryPolicy()
+        self._failed_students = []
+        self._verbose = verbose
+        self._interactive = True
+        self._smtp_password = None
         # Retrieve paths selected in Nautilus if files/folders not provided
-        if not list_of_paths:
+        if list_of_paths is None:
             try:
                 list_of_paths = os.environ[
                                         'NAUTILUS_SCRIPT_SELECTED_FILE_PATHS']
-            except:
+            except KeyError:
                 print(f"ERROR: no files/folders provided"
-                      f" neither selected in Nautilus\n{e}")
+                      f" neither selected in Nautilus")
+                list_of_paths = ""
+        self.select_files(list_of_paths, recursive=recursive,
+                          include=include, exclude=exclude)
+
+    def select_files(self, list_of_paths, recursive=False,
+                     include=None, exclude=None):
+        """Select the files to send (paths separated by new lines).
+
+        Replace the files selected before, see __init__ for the options.
+        """
+        self._list_of_files = []
+        self._files = self._iter_files([path for path
+                                        in list_of_paths.splitlines()
+                                        if path],
+                                       recursive=recursive,
+                                       include=include, exclude=exclude)
 
-        # Keep files which are not sym link and parse folders
-        for path in list_of_paths.splitlines():
+    def _iter_files(self, list_of_paths, recursive=False,
+                    include=None, exclude=None):
+        """Yield files (not sym links) from a list of files and folders.
+
+        Folders are read with os.scandir (no extra stat call per file).
+        """
+        def keep(name):
+            return ((not include or any(fnmatch.fnmatch(name, pattern)
+                                        for pattern in include))
+                    and not any(fnmatch.fnmatch(name, pattern)
+                                for pattern in exclude or []))
+
+        for path in list_of_paths:
             # path is a file: keep if not sym link
             if os.path.isfile(path):
-                if not os.path.islink(path):
-                    self._list_of_files.append(path)
-            # path is a folder: parse it and keep if not sym link
-            else:
-                for f in os.listdir(path):
-                    newpath = os.path.join(path, f)
-                    if os.path.isfile(newpath) and not os.path.islink(newpath):
-                        self._list_of_files.append(newpath)
+                if not os.path.islink(path) and keep(os.path.basename(path)):
+                    yield path
+                continue
+            # path is a folder: parse it (and its subfolders if recursive)
+            folders = [path]
+            while folders:
+                subfolders = []
+                with os.scandir(folders.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_file(follow_symlinks=False):
+                            if keep(entry.name):
+                                yield entry.path
+                        elif recursive and entry.is_dir(follow_symlinks=False):
+                            subfolders.append(entry.path)
+                folders.extend(reversed(subfolders))
 
-        print(f"{len(self._list_of_files)} files selected")
-        if verbose:
-            print(" " + "\n ".join(self._list_of_files))
-
-    def identify_students(self, csv_filepath, verbose=False, **kwargs):
+    def identify_students(self, csv_filepath, verbose=False,
+                          amc_project=None, **kwargs):
         """
         Link each file to the corresponding student.
 
+        If amc_project (AMC project folder) is given, files are matched using
+        AMC databases, otherwise using the first number of their names.
         Create a _matched_students attribute which is a list of students.
         """
-        self._get_students_from_csv(csv_filepath, verbose=verbose, **kwargs)
-        self._associate_quiz_to_student(verbose=verbose)
+        with self._metrics.phase("csv load"):
+            self._get_students_from_csv(csv_filepath, verbose=verbose,
+                                        **kwargs)
+        self._associate_quiz_to_student(verbose=verbose,
+                                        amc_project=amc_project)
 
     def _get_students_from_csv(self, csv_filepath, verbose,
                                csv_delimiter=";",
@@ -183,30 +1175,61 @@ class AMCtoOwncloud:
             for student in self._dict_of_students.values():
                 print(student)
 
-    def _associate_quiz_to_student(self, verbose=False):
+    def _associate_quiz_to_student(self, verbose=False, amc_project=None):
         """Associate each quiz to a student.
 
+        With amc_project, the annotated file name gives the student number
+        (see _read_amc_project); other files fall back to the first number
+        in their names. Problems are reported in one summary at the end,
+        without asking to continue.
         Update quiz attribute of each student with the corresponding file path.
         Create a _matched_students attribute which is a list of students.
         """
         self._matched_students = []
         unmatched_quiz = []
+        duplicated_quiz = []
         regular_expression = re.compile('[0-9]+')
-
-        for quiz_path in self._list_of_files:
-            # extract the first number in the file name
-            quiz_name = os.path.basename(quiz_path)
-            match = re.search(regular_expression, quiz_name)
+        amc_index, ambiguous_quiz = {}, set()
+        if amc_project:
             try:
-                student_number = match.group()                
-                # update the quiz attribute with file path
-                self._dict_of_students[student_number].quiz = quiz_path
-                self._matched_students.append(
-                                        self._dict_of_students[student_number])
-            except:
-                # store unmatched files (no student number or incorrect number)
-                unmatched_quiz.append(quiz_path)
+                with self._metrics.phase("read AMC project"):
+                    amc_index, ambiguous_quiz = self._read_amc_project(
+                                                                amc_project)
+            except (OSError, sqlite3.Error) as e:
+                print(f'ERROR: AMC project "{amc_project}" couldn\'t be read,'
+                      f" files are matched by the numbers in their names"
+                      f"\n{e}")
+                amc_project = None
 
+        # "scan and match" includes the time spent in "file scan"
+        files = self._metrics.timed_iter("file scan", self._files)
+        with self._metrics.phase("scan and match"):
+            for quiz_path in files:
+                self._list_of_files.append(quiz_path)
+                quiz_name = os.path.basename(quiz_path)
+                if quiz_name in ambiguous_quiz:
+                    unmatched_quiz.append(quiz_path)
+                    continue
+                student_number = amc_index.get(quiz_name)
+                # extract the first number in the file name
+                if student_number is None:
+                    match = re.search(regular_expression, quiz_name)
+                    student_number = match and match.group()
+                student = self._dict_of_students.get(student_number)
+                if student is None:
+                    # store unmatched files (no number or incorrect number)
+                    unmatched_quiz.append(quiz_path)
+                elif student.quiz:
+                    # keep the first file found for a student
+                    duplicated_quiz.append(quiz_path)
+                else:
+                    # update the quiz attribute with file path
+                    student.quiz = quiz_path
+                    self._matched_students.append(student)
+
+        print(f"\n{len(self._list_of_files)} files selected")
+        if self._verbose:
+            print(" " + "\n ".join(self._list_of_files))
         print(f"\n{len(self._matched_students)}/"
               f"{len(self._list_of_files)} files matched")
         if verbose:
@@ -216,34 +1239,181 @@ class AMCtoOwncloud:
         if len(self._matched_students) != len(self._list_of_files):
             print("Unmatched file(s):")
             for quiz_path in unmatched_quiz:
-                print(f" {quiz_path}")
-            cancel = input("Do you want to continue? (y/n) ")
-            if cancel.lower() == "n":
-                quit("\nScript cancelled !")
+                reason = (" (several students in AMC project)"
+                          if os.path.basename(quiz_path) in ambiguous_quiz
+                          else "")
+                print(f" {quiz_path}{reason}")
+            for quiz_path in duplicated_quiz:
+                print(f" {quiz_path} (student already has a file)")
+            if not amc_project and self._interactive:
+                cancel = input("Do you want to continue? (y/n) ")
+                if cancel.lower() == "n":
+                    quit("\nScript cancelled !")
+
+    @staticmethod
+    def _read_amc_project(amc_project):
+        """Index annotated files of an AMC project by student number.
 
-    def connect_owncloud(self, address, username, password=None, SSO=False):
+        Read once data/report.sqlite (annotated file of each copy) and
+        data/association.sqlite (student number of each copy, manual
+        association first).
+        Return the index (key = file name, value = student number) and the
+        set of file names associated to several students.
+        Raise FileNotFoundError if a database is missing.
+        """
+        data = Path(os.path.expanduser(amc_project), "data")
+        for database in ("report.sqlite", "association.sqlite"):
+            if not (data / database).is_file():
+                raise FileNotFoundError(f'No AMC database "{data / database}"')
+        db = sqlite3.connect((data / "report.sqlite").resolve().as_uri() +
+                             "?mode=ro", uri=True)
+        try:
+            db.execute("ATTACH DATABASE ? AS association",
+                       ((data / "association.sqlite").resolve().as_uri() +
+                        "?mode=ro",))
+            rows = db.execute(
+                "SELECT r.file, COALESCE(a.manual, a.auto)"
+                " FROM report_student AS r"
+                " JOIN association.association_association AS a"
+                " ON a.student = r.student AND a.copy = r.copy"
+                " WHERE r.type = 1"  # REPORT_ANNOTATED_PDF
+                " AND COALESCE(a.manual, a.auto) IS NOT NULL").fetchall()
+        finally:
+            db.close()
+
+        amc_index = {}
+        ambiguous_quiz = set()
+        for quiz_file, student_number in rows:
+            if isinstance(student_number, float):  # 3998.0 -> "3998"
+                student_number = int(student_number)
+            student_number = str(student_number)
+            quiz_name = os.path.basename(quiz_file)
+            if amc_index.setdefault(quiz_name,
+                                    student_number) != student_number:
+                ambiguous_quiz.add(quiz_name)
+        for quiz_name in ambiguous_quiz:
+            del amc_index[quiz_name]
+        return amc_index, ambiguous_quiz
+
+    def connect_owncloud(self, address, username, password=None, SSO=False,
+                         credentials_file=None, pool_size=10):
         """Prompt for a password, connect to Owncloud.
 
+        If credentials_file is given, the app password saved there by a
+        previous run is tried first (one request) and a new one is saved
+        after a full login (file only readable by the user).
+        Every request then goes through a pooled keep-alive session with
+        pool_size connections per host (see Transport).
         Create an _cloud_client attribute.
         """
+        self._username = username
+        if self._transport is None:
+            self._transport = Transport(pool_size=pool_size)
+        if credentials_file and self._connect_with_saved_credentials(
+                                        address, username, credentials_file):
+            print('\nConnected with saved credentials !')
+            return
         if password is None:
             password = getpass.getpass("\nEnter Owncloud password: ")
         print("Connecting to Owncloud... ", end="")
         try:
-            if SSO:
-                self._connect_owncloud_behind_sso(address, username, password)
-            else:
-                self._cloud_client = owncloud.Client(address)
-                self._cloud_client.login(username, password)
+            with self._metrics.phase("login"):
+                if SSO:
+                    self._connect_owncloud_behind_sso(address, username,
+                                                      password)
+                else:
+                    self._cloud_client = owncloud.Client(address)
+                    self._remote_call("login", self._cloud_client.login,
+                                      username, password)
+                    self._use_transport()
         except Exception as e:
             print(f"Error logging in!\n{e}")
+            if not self._interactive:
+                raise
             retry = input("Try again? (y/n) ")
             if retry.lower() == "y":
-                self._cloud_client = self.connect_owncloud(address, username,
-                                                           password=None)
+                self.connect_owncloud(address, username, password=None,
+                                      SSO=SSO,
+                                      credentials_file=credentials_file)
+                return
             else:
                 quit()
         print('Connected !')
+        if credentials_file:
+            self._save_credentials(address, username, credentials_file)
+
+    def _connect_with_saved_credentials(self, address, username,
+                                        credentials_file):
+        """Log in with a saved app password, return False if not valid."""
+        try:
+            with open(os.path.expanduser(credentials_file)) as f:
+                credentials = json.load(f)
+            if (credentials["address"], credentials["username"]) != (
+                                                        address, username):
+                return False
+            with self._metrics.phase("login"):
+                self._cloud_client = owncloud.Client(address)
+                self._remote_call("login", self._cloud_client.login,
+                                  username, credentials["app_password"])
+                self._use_transport()
+        except Exception:  # no file, expired or revoked password
+            self._cloud_client = None
+            return False
+        return True
+
+    def _use_transport(self):
+        """Replace the session created by pyocclient login by the pooled one"""
+        session = self._transport.session
+        session.auth = HostBasicAuth(self._cloud_client.url,
+                                     *self._cloud_client._session.auth)
+        session.verify = self._cloud_client._verify_certs
+        self._cloud_client._session.close()
+        self._cloud_client._session = session
+
+    def report_metrics(self, json_filepath=None, prometheus_filepath=None):
+        """Print the time spent in each phase and remote call.
+
+        Metrics can also be saved as JSON and/or as a Prometheus textfile
+        to compare runs.
+        """
+        print("\n" + self._metrics.summary())
+        if json_filepath:
+            self._metrics.write_json(json_filepath)
+            print(f'Metrics saved to "{json_filepath}"')
+        if prometheus_filepath:
+            self._metrics.write_prometheus(prometheus_filepath)
+            print(f'Metrics saved to "{prometheus_filepath}"')
+
+    def connection_stats(self):
+        """Connection reuse statistics of the pooled session (see Transport)"""
+        return self._transport.stats()
+
+    def _save_credentials(self, address, username, credentials_file):
+        """Ask the server for an app password and save it for next runs.
+
+        Needs Nextcloud 15+ (core/getapppassword), otherwise nothing is saved.
+        """
+        try:
+            res = self._cloud_client._session.get(
+                    self._cloud_client.url + "ocs/v2.php/core/getapppassword",
+                    headers={"OCS-APIREQUEST": "true"})
+            app_password = ET.fromstring(res.content).findtext(
+                                                        "data/apppassword")
+        except Exception:
+            app_password = None
+        if not app_password:
+            print("Credentials not saved (no app password from the server)")
+            return
+        credentials_file = os.path.expanduser(credentials_file)
+        os.makedirs(os.path.dirname(credentials_file) or ".", mode=0o700,
+                    exist_ok=True)
+        fd = os.open(credentials_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"address": address, "username": username,
+                       "app_password": app_password}, f)
+        print(f'Credentials saved to "{credentials_file}"')
 
     def _connect_owncloud_behind_sso(self, address, username, password):
         """Hack to connect to Owncloud behind a SSO (single sign on).
@@ -251,7 +1421,9 @@ class AMCtoOwncloud:
         Why does it work? https://github.com/owncloud/pyocclient/issues/204
         """
         # Get the hidden form fields needed to log in (CSRF token)
-        s = requests.session()
+        s = self._transport.session
+        s.auth = None
+        s.cookies.clear()
         sso_address = s.get(address).url  # follow redirection
         login = s.get(sso_address)
         login_html = lxml.html.fromstring(login.text)
@@ -268,9 +1440,9 @@ class AMCtoOwncloud:
         self._cloud_client = owncloud.Client(address)
         self._cloud_client._session = s
         self._cloud_client._update_capabilities()
-        self._cloud_client._session = requests.session()
-        self._cloud_client._session.verify = self._cloud_client._verify_certs
-        self._cloud_client._session.auth = (username, password)
+        s.cookies.clear()  # SSO cookies are not needed anymore
+        s.verify = self._cloud_client._verify_certs
+        s.auth = HostBasicAuth(address, username, password)
 
     def upload_and_share(self, folder_root="",
                          folder_name=" - Maths Quizzes",
@@ -278,7 +1450,21 @@ class AMCtoOwncloud:
                          share_with_user=True,
                          share_by_link=True,
                          shorten_link=True,
-                         replace_csv=False):
+                         replace_csv=False,
+                         max_workers=1,
+                         force=False,
+                         resume=False,
+                         chunked_threshold=10*1024*1024,
+                         chunk_size=5*1024*1024,
+                         shortener_rate=1.0,
+                         shortener_url="https://tinyurl.com/api-create.php",
+                         csv_flush_interval=60,
+                         retries=5,
+                         compress=False,
+                         compress_dpi=150,
+                         compress_quality="ebook",
+                         compress_workers=None,
+                         journal_filepath=None):
         """Create remote folders, upload files, share with user and/or by link.
 
         - Create remote folders for each students (if not already there):
@@ -289,30 +1475,584 @@ class AMCtoOwncloud:
         - Share folders by link
         - Shorten link
         - Save links to .csv (if replace_csv=True)
+
+        Students are processed by a pool of max_workers threads (one task
+        per student, steps of a task run in order).
+        Unchanged files already sent (see the .manifest.sqlite file next to
+        the .csv file) are not uploaded again, unless force=True.
+        Completed steps are saved in a .journal file next to the .csv file
+        (or in journal_filepath): with resume=True, an interrupted run
+        continues where it stopped.
+        Links are saved to .csv at the end, even if the run is interrupted
+        (a write error is then printed, not raised, so that the error
+        which stopped the run is not hidden), and every csv_flush_interval
+        seconds during the run. Each save rewrites the whole .csv file,
+        hence a time interval rather than a number of students.
+        Files bigger than chunked_threshold bytes are sent by chunks of
+        chunk_size bytes (a failed chunk is sent again alone).
+        Links are shortened only once (see the .shortlinks.json cache file
+        next to the .csv file), with at most shortener_rate requests/second.
+        Failed requests are retried up to retries times and fewer requests
+        are sent at once when the server is overloaded (see RetryPolicy).
+        Students still failing are listed in a .rerun.txt file next to the
+        journal (paths of their papers, to pass as list_of_paths).
+        With compress=True, .pdf papers are first made smaller by ghostscript
+        (compress_workers processes, images at compress_dpi, quality preset
+        compress_quality, see PdfCompressor), compressed files are cached in
+        a .compressed folder next to the .csv file.
         """
+        csv_filepath = Path(self._csvfile["csv_filepath"])
+        journal_filepath = Path(journal_filepath or
+                                csv_filepath.with_suffix(".journal"))
+        self._journal = RunJournal(journal_filepath, resume=resume)
+        if quiz_name is None:
+            quiz_name = self._journal.run.get("quiz_name")
         if quiz_name is None:
             quiz_name = input('\nEnter quiz name: ')
+        previous_run = self._journal.run
+        if not self._journal.start(quiz_name=quiz_name,
+                                   folder_root=folder_root,
+                                   folder_name=folder_name):
+            print(f'\nJournal "{journal_filepath}" is from another run'
+                  f" ({previous_run}), this run starts from the beginning")
+        for student in self._matched_students:
+            steps = self._journal.steps.get(student.number, {})
+            student.link = steps.get("link", student.link)
+            student.shortlink = steps.get("shortlink", student.shortlink)
 
         # For display
         students_total = len(self._matched_students)
         nb_digits = math.floor(math.log10(students_total)+1)
-        students_current = 0
         print('\nUploading files...')
 
+        # Open manifest of files already uploaded
+        self._manifest = UploadManifest(
+                            csv_filepath.with_suffix(".manifest.sqlite"))
+        self._upload_stats = {"sent_files": 0, "sent_bytes": 0,
+                              "skipped_files": 0, "skipped_bytes": 0}
+
+        # Load short links already known
+        self._shortener = LinkShortener(
+                    csv_filepath.with_suffix(".shortlinks.json"),
+                    links=((student.link, student.shortlink)
+                           for student in self._dict_of_students.values()),
+                    api_url=shortener_url,
+                    requests_per_second=shortener_rate,
+                    session=self._transport and self._transport.session,
+                    metrics=self._metrics)
+
+        self._retry_policy = RetryPolicy(retries=retries,
+                                         max_in_flight=max_workers)
+        self._failed_students = []
+
+        # Compress papers if asked
+        self._upload_paths = {}
+        if compress:
+            compressor = PdfCompressor(csv_filepath.with_suffix(".compressed"),
+                                       dpi=compress_dpi,
+                                       quality=compress_quality,
+                                       max_workers=compress_workers)
+            with self._metrics.phase("compress"):
+                self._upload_paths = compressor.compress_all(
+                        [student.quiz for student in self._matched_students])
+            stats = compressor.stats
+            saved = stats["original_bytes"] - stats["compressed_bytes"]
+            print(f'{stats["compressed_files"]} papers compressed,'
+                  f' {stats["kept_files"]} kept as is'
+                  f' ({saved / 1e6:.1f} MB saved,'
+                  f' {saved / max(stats["original_bytes"], 1):.0%} less)')
+
         # Create root folder if necessary
+        with self._metrics.phase("remote snapshot"):
+            self._load_remote_tree(folder_root)
+            if self._mkdir_if_missing(folder_root):
+                print(f'Root folder created at "{folder_root}"')
+            self._load_share_index(folder_root)
+
+        with self._metrics.phase("upload and share"):
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            try:
+                futures = []
+                for students_current, student in enumerate(
+                                            self._matched_students, start=1):
+                    display_counter = (f"{students_current:0>{nb_digits}d}/"
+                                       f"{students_total}")
+                    futures.append(executor.submit(
+                                        self._upload_and_share_student,
+                                        student, display_counter,
+                                        folder_root=folder_root,
+                                        folder_name=folder_name,
+                                        quiz_name=quiz_name,
+                                        share_with_user=share_with_user,
+                                        share_by_link=share_by_link,
+                                        shorten_link=shorten_link,
+                                        force=force,
+                                        chunked_threshold=chunked_threshold,
+                                        chunk_size=chunk_size))
+                next_flush = time.monotonic() + csv_flush_interval
+                for future in as_completed(futures):
+                    future.result()
+                    if share_by_link and time.monotonic() >= next_flush:
+                        self._write_links_to_csv(replace_csv=replace_csv,
+                                                 quiet=True)
+                        next_flush = time.monotonic() + csv_flush_interval
+            except BaseException:
+                interrupted = True
+                print("\nRun interrupted! Run again with resume=True"
+                      " (or --resume) to continue where it stopped.")
+                raise
+            else:
+                interrupted = False
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+                self._journal.close()
+                if share_by_link:
+                    try:
+                        self._write_links_to_csv(replace_csv=replace_csv)
+                    except Exception as e:
+                        # don't hide the exception which stopped the run
+                        if not interrupted:
+                            raise
+                        print(f"ERROR: links couldn't be saved to .csv\n{e}")
+                self._write_rerun_list(
+                                journal_filepath.with_suffix(".rerun.txt"))
+
+        if self._upload_stats["skipped_files"]:
+            print(f'\n{self._upload_stats["skipped_files"]} unchanged files'
+                  f' not sent again'
+                  f' ({self._upload_stats["skipped_bytes"] / 1e6:.1f} MB,'
+                  f' {self._upload_stats["skipped_files"]} requests saved)')
+        if self._retry_policy.retried:
+            print(f'\n{self._retry_policy.retried} requests retried'
+                  f' (at most {int(self._retry_policy.limit)} requests'
+                  f' at once at the end of the run)')
+        if self._transport:
+            stats = self.connection_stats()
+            print(f'\n{stats["requests"]} requests sent with'
+                  f' {stats["connections"]} connections'
+                  f' ({stats["tls_handshakes"]} TLS handshakes,'
+                  f' {stats["reused"]} requests on reused connections)')
+
+    def run_batch(self, config_filepath, force=False, resume=False):
+        """Run several jobs described in a config file, without questions.
+
+        The [DEFAULT] section gives the connection (address, username,
+        credentials_file, sso, pool_size) and default job options, each
+        other section is a job (section name = default quiz name):
+        - csv, papers (one path per line), quiz_name, folder_root,
+        folder_suffix (quotes are removed, to keep spaces), amc_project
+        - recursive, include, exclude (one pattern per line)
+        - share_with_user, share_by_link, shorten_link, replace_csv,
+        max_workers, compress, letters (write information letters),
+        send_emails (with smtp_host, smtp_port, smtp_username,
+        smtp_security and sender)
+        All jobs share one login, connection pool, remote tree snapshot and
+        share index. Each job has its own journal next to its .csv file.
+        Return the combined report (one dict per job), also printed.
+        """
+        config = configparser.ConfigParser(interpolation=None)
+        if not config.read(os.path.expanduser(config_filepath)):
+            print(f'ERROR: config file "{config_filepath}" not found')
+            return []
+        settings = config[configparser.DEFAULTSECT]
+        self._interactive = False
+        self.connect_owncloud(address=settings["address"],
+                              username=settings["username"],
+                              SSO=settings.getboolean("sso", fallback=False),
+                              credentials_file=settings.get(
+                                                        "credentials_file"),
+                              pool_size=settings.getint("pool_size",
+                                                        fallback=10))
+
+        def text(job, option, fallback=""):
+            value = job.get(option)
+            return fallback if value is None else value.strip().strip('"')
+
+        def lines(job, option):
+            return [line.strip() for line in job.get(option, "").splitlines()
+                    if line.strip()]
+
+        report = []
+        for name in config.sections():
+            job = config[name]
+            print(f"\n########## {name} ##########")
+            result = {"job": name, "students": 0, "sent_files": 0,
+                      "skipped_files": 0, "failed": 0, "error": None}
+            report.append(result)
+            try:
+                csv_filepath = Path(os.path.expanduser(job["csv"]))
+                self.select_files(
+                        "\n".join(os.path.expanduser(path)
+                                  for path in lines(job, "papers")),
+                        recursive=job.getboolean("recursive", fallback=False),
+                        include=lines(job, "include") or None,
+                        exclude=lines(job, "exclude") or None)
+                self.identify_students(str(csv_filepath),
+                                       amc_project=job.get("amc_project"))
+                result["students"] = len(self._matched_students)
+                if not self._matched_students:
+                    continue
+                slug = re.sub(r"[^\w-]+", "_", name)
+                self.upload_and_share(
+                        folder_root=text(job, "folder_root"),
+                        folder_name=text(job, "folder_suffix",
+                                         " - Maths Quizzes"),
+                        quiz_name=text(job, "quiz_name", name),
+                        share_with_user=job.getboolean("share_with_user",
+                                                       fallback=True),
+                        share_by_link=job.getboolean("share_by_link",
+                                                     fallback=True),
+                        shorten_link=job.getboolean("shorten_link",
+                                                    fallback=True),
+                        replace_csv=job.getboolean("replace_csv",
+                                                   fallback=False),
+                        max_workers=job.getint("max_workers", fallback=1),
+                        compress=job.getboolean("compress", fallback=False),
+                        force=force, resume=resume,
+                        journal_filepath=csv_filepath.with_name(
+                                    f"{csv_filepath.stem}.{slug}.journal"))
+                result["sent_files"] = self._upload_stats["sent_files"]
+                result["skipped_files"] = self._upload_stats["skipped_files"]
+                result["failed"] = len(self._failed_students)
+                if job.getboolean("letters", fallback=False):
+                    self.write_letters(csv_filepath.with_name(
+                                f"{csv_filepath.stem}.{slug}-letters.pdf"))
+                if job.getboolean("send_emails", fallback=False):
+                    self.send_emails(job["smtp_host"],
+                                     port=job.getint("smtp_port",
+                                                     fallback=587),
+                                     sender=job.get("sender"),
+                                     username=job.get("smtp_username"),
+                                     security=job.get("smtp_security",
+                                                      "starttls"))
+            except Exception as e:
+                print(f'ERROR: job "{name}" stopped\n{e}')
+                result["error"] = str(e)
+
+        print(f"\n{'Job':30} {'Students':>8} {'Sent':>6} {'Unchanged':>9}"
+              f" {'Failed':>6}")
+        for result in report:
+            print(f"{result['job']:30.30} {result['students']:8d}"
+                  f" {result['sent_files']:6d} {result['skipped_files']:9d}"
+                  f" {result['failed']:6d}"
+                  + (" ERROR" if result["error"] else ""))
+        return report
+
+    def write_letters(self, pdf_filepath=None, per_group=False, groups=None,
+                      max_workers=None, **kwargs):
+        """Write information letters for students with a shared link.
+
+        Letters are made from the students in memory (after
+        upload_and_share, or with links from the .csv file), in the order
+        of the .csv file, optionally only for some groups.
+        Default file: "students-letters.pdf" next to the .csv file, or one
+        file per group with per_group=True.
+        Other options (subject, signature) are passed to LetterWriter.
+        """
         try:
-            self._cloud_client.mkdir(folder_root)
-            print(f'Root folder created at "{folder_root}"')
-        except:
-            pass
+            import reportlab
+        except ImportError:
+            print("ERROR: reportlab is needed to write letters"
+                  " (pip3 install reportlab)")
+            return []
+        csv_filepath = Path(self._csvfile["csv_filepath"])
+        if pdf_filepath is None:
+            pdf_filepath = csv_filepath.with_name(
+                                        f"{csv_filepath.stem}-letters.pdf")
+        writer = LetterWriter(max_workers=max_workers, **kwargs)
+        students = writer.select(self._dict_of_students.values(),
+                                 groups=groups)
+        with self._metrics.phase("letters"):
+            filepaths = writer.write(students, pdf_filepath,
+                                     per_group=per_group)
+        for filepath in filepaths:
+            print(f'Information letters saved to "{filepath}"')
+        print(f"{len(students)} letters written")
+        return filepaths
 
-        for student in self._matched_students:
-            students_current += 1
-            display_counter = (f"{students_current:0>{nb_digits}d}/"
-                               f"{students_total}")
-            print(f'{display_counter} Student {student.number}'
-                  f' - {student.surname} {student.name}')
+    def send_emails(self, host, port=587, sender=None, username=None,
+                    password=None, security="starttls", use_shortlink=True,
+                    groups=None, **kwargs):
+        """E-mail their link to the students matched in this run.
+
+        Messages are sent to the email column of the .csv file, through
+        an SMTP server (a password is asked once per session if username
+        is given without password). Messages already sent are listed in a
+        .emails.jsonl file next to the .csv file and never sent again.
+        Other options (subject_template, template, fields,
+        messages_per_second, batch_size, pool_size) are passed to Mailer.
+        """
+        if username and password is None:
+            password = self._smtp_password or getpass.getpass(
+                            f"\nEnter password of {username} on {host}: ")
+            self._smtp_password = password
+        csv_filepath = Path(self._csvfile["csv_filepath"])
+        mailer = Mailer(host, port=port, sender=sender, username=username,
+                        password=password, security=security,
+                        sent_log_filepath=csv_filepath.with_suffix(
+                                                            ".emails.jsonl"),
+                        metrics=self._metrics, **kwargs)
+        students = [student for student in self._matched_students
+                    if not groups or student.group in groups]
+        print("\nSending e-mails...")
+        with self._metrics.phase("e-mails"):
+            stats = mailer.send(students, use_shortlink=use_shortlink)
+        print(f'{stats["sent"]} e-mails sent,'
+              f' {stats["already_sent"]} already sent before,'
+              f' {stats["failed"]} failed')
+        return stats
+
+    def _write_rerun_list(self, rerun_filepath):
+        """Save the papers of students who failed, one path per line.
+
+        The file is removed when every student succeeded.
+        """
+        if not self._failed_students:
+            if rerun_filepath.exists():
+                rerun_filepath.unlink()
+            return
+        with open(rerun_filepath, "w") as f:
+            for student in self._failed_students:
+                f.write(student.quiz + "\n")
+        print(f"\nERROR: {len(self._failed_students)} students failed,"
+              f' their papers are listed in "{rerun_filepath}"'
+              f" (run again with these paths or with --resume)")
+
+    def _remote_call(self, name, function, *args, nbytes=0, idempotent=True,
+                     **kwargs):
+        """Call function (a remote request), recorded as name in metrics.
+
+        Each attempt is timed, failed attempts are retried by _retry_policy.
+        """
+        def attempt():
+            with self._metrics.call(name, nbytes=nbytes) as call:
+                call["response"] = function(*args, **kwargs)
+            return call["response"]
+        return self._retry_policy.call(attempt, idempotent=idempotent)
 
+    def _put_file(self, remote_path, local_path):
+        """Upload a file in one PUT request, return its new etag.
+
+        Same request as pyocclient put_file, whose answer (and its ETag
+        header) is not returned by pyocclient.
+        """
+        client = self._cloud_client
+        url = (client._webdav_url +
+               parse.quote(self._normalize_remote_path(remote_path)))
+        headers = {"X-OC-MTIME": str(int(os.path.getmtime(local_path)))}
+
+        def put():
+            with open(local_path, "rb") as f:  # opened again if retried
+                return client._session.put(url, data=f, headers=headers)
+
+        res = self._remote_call("put_file", put,
+                                nbytes=os.path.getsize(local_path))
+        if res.status_code not in (201, 204):
+            raise owncloud.HTTPResponseError(res)
+        return self._etag(res, remote_path)
+
+    def _etag(self, res, remote_path):
+        """Etag of an uploaded file: from the answer, or else PROPFIND"""
+        etag = res.headers.get("OC-ETag") or res.headers.get("ETag")
+        if etag is None:
+            file_info = self._remote_call("file_info",
+                                          self._cloud_client.file_info,
+                                          remote_path)
+            etag = file_info and file_info.attributes.get("{DAV:}getetag")
+        return etag
+
+    def _put_file_chunked(self, remote_path, local_path,
+                          chunk_size=5*1024*1024):
+        """Upload a big file by chunks (Nextcloud/Owncloud chunked upload).
+
+        - Create an upload folder: remote.php/dav/uploads/user/id
+        - Send chunks 00001, 00002... (only one chunk in memory at a time,
+        a failed chunk is sent again alone by _remote_call)
+        - Move the assembled ".file" to its destination
+        Return the etag of the new file.
+        """
+        client = self._cloud_client
+        session = client._session
+        user = parse.quote(self._username)
+        upload_url = (f"{client.url}remote.php/dav/uploads/{user}/"
+                      f"AMCtoOwncloud-{uuid.uuid4().hex}")
+        destination = (f"{client.url}remote.php/dav/files/{user}" +
+                       parse.quote(self._normalize_remote_path(remote_path)))
+        headers = {"Destination": destination}
+
+        res = self._remote_call("chunked_mkcol", session.request,
+                                "MKCOL", upload_url, headers=headers)
+        if res.status_code != 201:
+            raise owncloud.HTTPResponseError(res)
+        try:
+            with open(local_path, "rb") as f:
+                for index, chunk in enumerate(iter(lambda: f.read(chunk_size),
+                                                   b""), start=1):
+                    res = self._remote_call("chunked_put", session.put,
+                                            f"{upload_url}/{index:05d}",
+                                            data=chunk, headers=headers,
+                                            nbytes=len(chunk))
+                    if res.status_code not in (201, 204):
+                        raise owncloud.HTTPResponseError(res)
+        except Exception:
+            try:  # clean up once, without hiding the error of the chunk
+                with self._metrics.call("chunked_delete") as call:
+                    call["response"] = session.request("DELETE", upload_url)
+            except requests.RequestException:
+                pass
+            raise
+        headers["OC-Total-Length"] = str(os.path.getsize(local_path))
+        res = self._remote_call("chunked_move", session.request,
+                                "MOVE", upload_url + "/.file", headers=headers)
+        if res.status_code not in (201, 204):
+            raise owncloud.HTTPResponseError(res)
+        return self._etag(res, remote_path)
+
+    def _load_remote_tree(self, folder_root):
+        """Take a snapshot of the remote tree under folder_root.
+
+        A single recursive PROPFIND (Depth: infinity) lists every folder and
+        file already on the server, so that mkdir is only sent for missing
+        folders. Servers without infinite depth (ownCloud 10, older
+        Nextcloud) silently answer with depth 1: the subfolders are then
+        listed one level at a time (Depth: 1). If listing fails, folders
+        are created blindly (as before).
+        The snapshot is kept for the session: a folder_root inside a folder
+        already listed (e.g. by a previous batch job) is not listed again.
+        Create a _remote_tree attribute (key = path, value = etag) and a
+        _remote_tree_listed attribute (set of folders whose whole content
+        is known: a path missing from _remote_tree is only known to be
+        missing on the server if its parent folder is in this set).
+        """
+        root = self._normalize_remote_path(folder_root)
+        if self._remote_tree is None:
+            self._remote_tree = {"/": None}
+            self._remote_tree_listed = set()
+            self._remote_tree_lock = threading.Lock()
+            self._remote_tree_locks = {}
+            self._remote_tree_roots = []
+        elif self._is_under(root, self._remote_tree_roots):
+            return
+        try:
+            folders = self._list_remote_folder(root, depth="infinity")
+            if folders is None:  # root folder not created yet
+                self._remote_tree_roots.append(root)
+                return
+            if any(path.count("/") > root.rstrip("/").count("/") + 1
+                   for path in self._remote_tree
+                   if self._is_under(path, [root])):
+                # infinite depth honoured: every folder has been listed
+                self._remote_tree_listed.update(folders)
+            else:
+                while folders:  # depth capped at 1
+                    folders = [subfolder for folder in folders
+                               for subfolder in self._list_remote_folder(
+                                                    folder, depth=1) or []]
+        except owncloud.HTTPResponseError as e:
+            print(f"Remote folders couldn't be listed,"
+                  f" they will be created blindly\n{e}")
+        self._remote_tree_roots.append(root)
+
+    def _list_remote_folder(self, folder, depth):
+        """Add the content of a remote folder to the remote tree snapshot.
+
+        Mark folder as listed, return its subfolders found (all of them
+        with depth="infinity"), or None if folder doesn't exist.
+        """
+        try:
+            files = self._remote_call("list", self._cloud_client.list,
+                                      folder, depth=depth)
+        except owncloud.HTTPResponseError as e:
+            if e.status_code == 404:
+                return None
+            raise
+        subfolders = []
+        for file_info in files:
+            path = self._normalize_remote_path(file_info.path)
+            self._remote_tree[path] = file_info.attributes.get(
+                                                        "{DAV:}getetag")
+            if file_info.is_dir():
+                subfolders.append(path)
+        self._remote_tree[folder] = None
+        self._remote_tree_listed.add(folder)
+        return subfolders
+
+    def _load_share_index(self, folder_root):
+        """Fetch every share of the account under folder_root at once.
+
+        One OCS request replaces the two get_shares calls per student.
+        The index is then updated when new shares are created, and kept for
+        the session like the remote tree (see _load_remote_tree).
+        Create a _share_index attribute (key = path,
+        value = {"user": set of recipients, "link": list of links}).
+        """
+        root = self._normalize_remote_path(folder_root)
+        if self._share_index is None:
+            self._share_index = {}
+            self._share_index_roots = []
+        elif self._is_under(root, self._share_index_roots):
+            return
+        for file_share in self._remote_call("get_shares",
+                                            self._cloud_client.get_shares):
+            path = self._normalize_remote_path(file_share.get_path() or "")
+            if (not self._is_under(path, [root])
+                    or self._is_under(path, self._share_index_roots)):
+                continue
+            shares = self._share_index.setdefault(path, {"user": set(),
+                                                         "link": []})
+            if file_share.get_link() is not None:
+                shares["link"].append(file_share.get_link())
+            elif file_share.get_share_with() is not None:
+                shares["user"].add(file_share.get_share_with())
+        self._share_index_roots.append(root)
+
+    @staticmethod
+    def _is_under(path, roots):
+        """True if the remote path is one of roots or inside one of them"""
+        return any((path.rstrip("/") + "/").startswith(root.rstrip("/") + "/")
+                   for root in roots)
+
+    @staticmethod
+    def _normalize_remote_path(path):
+        """Remote path as stored in _remote_tree: "/Quizzes/3emeE" """
+        return "/" + path.strip("/")
+
+    def _mkdir_if_missing(self, path):
+        """Create a remote folder if it is not in the remote tree snapshot.
+
+        Each folder is created at most once per run, even when several
+        workers need it at the same time. Return True if it was created.
+        """
+        key = self._normalize_remote_path(path)
+        with self._remote_tree_lock:
+            lock = self._remote_tree_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key in self._remote_tree:
+                return False
+            try:
+                self._remote_call("mkdir", self._cloud_client.mkdir, path)
+                created = True
+                self._remote_tree_listed.add(key)  # new, hence empty
+            except:
+                # already there if the snapshot is incomplete
+                created = False
+            self._remote_tree[key] = None
+            return created
+
+    def _upload_and_share_student(self, student, display_counter,
+                                  folder_root, folder_name, quiz_name,
+                                  share_with_user, share_by_link,
+                                  shorten_link, force,
+                                  chunked_threshold, chunk_size):
+        """Upload and share the quiz of one student (run in a worker thread).
+
+        Messages are buffered and printed together once the student is done,
+        so that the output of concurrent students is not interleaved.
+        """
+        log = [f'{display_counter} Student {student.number}'
+               f' - {student.surname} {student.name}']
+        journal = self._journal
+        try:
             # Create remote folder if necessary
             folder_group = folder_root + student.group + "/"
             folder_student = (folder_group +
@@ -320,17 +2060,14 @@ class AMCtoOwncloud:
                               student.name +
                               " (" + student.number + ")" +
                               folder_name + "/")
-            try:
-                self._cloud_client.mkdir(folder_group)
-                print(f'{display_counter} Folder created at "{folder_group}"')
-            except:
-                pass
-            try:
-                self._cloud_client.mkdir(folder_student)
-                print(f'{display_counter} Folder created'
-                      f' at "{folder_student}"')
-            except:
-                pass
+            if not journal.done(student.number, "folder"):
+                if self._mkdir_if_missing(folder_group):
+                    log.append(f'{display_counter} Folder created'
+                               f' at "{folder_group}"')
+                if self._mkdir_if_missing(folder_student):
+                    log.append(f'{display_counter} Folder created'
+                               f' at "{folder_student}"')
+                journal.record(student.number, "folder", folder_student)
 
             # Define remote quiz name et send
             remote_quiz_name = (quiz_name + ' - ' +
@@ -338,82 +2075,152 @@ class AMCtoOwncloud:
                                 student.name + ' (' + student.number + ')' +
                                 '.' + student.quiz.split(".")[-1])  # extension
             remote_quiz_path = folder_student + remote_quiz_name
-            try:
-                self._cloud_client.put_file(remote_quiz_path, student.quiz)
-                print(f'{display_counter} File sent to "{remote_quiz_path}"')
-            except Exception as e:
-                print(f"ERROR: File couldn't be sent"
-                      f' to "{remote_quiz_path}"\n{e}')
+            local_path = self._upload_paths.get(student.quiz, student.quiz)
+            if journal.done(student.number, "upload"):
+                log.append(f'{display_counter} File already sent'
+                           f' to "{remote_quiz_path}"')
+            elif (not force) and self._manifest.is_uploaded(
+                                    local_path, remote_quiz_path,
+                                    remote_tree=self._remote_tree,
+                                    listed_folders=self._remote_tree_listed):
+                with self._print_lock:
+                    self._upload_stats["skipped_files"] += 1
+                    self._upload_stats["skipped_bytes"] += os.path.getsize(
+                                                                local_path)
+                log.append(f'{display_counter} File unchanged'
+                           f' at "{remote_quiz_path}"')
+                journal.record(student.number, "upload", remote_quiz_path)
+            else:
+                try:
+                    size = os.path.getsize(local_path)
+                    start = time.perf_counter()
+                    if size > chunked_threshold:
+                        etag = self._put_file_chunked(remote_quiz_path,
+                                                      local_path,
+                                                      chunk_size=chunk_size)
+                    else:
+                        etag = self._put_file(remote_quiz_path, local_path)
+                    duration = time.perf_counter() - start
+                    self._manifest.record(student.number, local_path,
+                                          remote_quiz_path, etag=etag)
+                    self._remote_tree[self._normalize_remote_path(
+                                                remote_quiz_path)] = etag
+                    with self._print_lock:
+                        self._upload_stats["sent_files"] += 1
+                        self._upload_stats["sent_bytes"] += size
+                    journal.record(student.number, "upload",
+                                   remote_quiz_path)
+                    log.append(f'{display_counter} File sent'
+                               f' to "{remote_quiz_path}"'
+                               f' ({size / 1e6:.1f} MB,'
+                               f' {size / 1e6 / max(duration, 1e-6):.1f} MB/s)')
+                except Exception as e:
+                    log.append(f"ERROR: File couldn't be sent"
+                               f' to "{remote_quiz_path}"\n{e}')
 
             # Share folders with user if necessary
-            is_shared = False
-            for file_share in self._cloud_client.get_shares(folder_student):
-                if file_share.get_share_with() == student.owncloud:
-                    is_shared = True
-                    break
+            shares = self._share_index.setdefault(
+                                self._normalize_remote_path(folder_student),
+                                {"user": set(), "link": []})
+            is_shared = (student.owncloud in shares["user"]
+                         or journal.done(student.number, "user_share"))
             if (not is_shared) and (share_with_user):
                 try:
                     if '@' in student.owncloud:  # remote user
-                        self._cloud_client.share_file_with_user(
+                        self._remote_call(
+                                "share_user",
+                                self._cloud_client.share_file_with_user,
                                 folder_student,
                                 student.owncloud + '/',  # bug pyocclient 0.4
-                                remote_user=True)
+                                remote_user=True, idempotent=False)
                     else:  # local user
-                        self._cloud_client.share_file_with_user(
-                                                            folder_student,
-                                                            student.owncloud)
-                    print(f"{display_counter} Folder"
-                          f' shared with user "{student.owncloud}"')
+                        self._remote_call(
+                                "share_user",
+                                self._cloud_client.share_file_with_user,
+                                folder_student, student.owncloud,
+                                idempotent=False)
+                    shares["user"].add(student.owncloud)
+                    journal.record(student.number, "user_share",
+                                   student.owncloud)
+                    log.append(f"{display_counter} Folder"
+                               f' shared with user "{student.owncloud}"')
                 except Exception as e:
-                    print(f"ERROR: Folder {folder_student} couldn't be"
-                          f' shared with user "{student.owncloud}"\n{e}')
+                    log.append(f"ERROR: Folder {folder_student} couldn't be"
+                               f' shared with user "{student.owncloud}"\n{e}')
 
             # Share folder by link if necessary
-            if (share_by_link):
+            if (share_by_link) and journal.done(student.number, "link"):
+                log.append(f"{display_counter} Folder"
+                           f' already shared by link "{student.link}"')
+            elif (share_by_link):
                 link_tmp = ""
-                for file_share in self._cloud_client.get_shares(folder_student):
-                    if (file_share.get_link() is not None):
-                        link = file_share.get_link()
-                        # no link yet ? Let's take an existing one
-                        if student.link == "":
-                            student.link = link
-                            break
-                        # existing link same as in csv, nothing to do
-                        elif student.link == link:
-                            break
-                        # another link as in csv, let's keep it in case
-                        else:
-                            link_tmp = link
+                for link in shares["link"]:
+                    # no link yet ? Let's take an existing one
+                    if student.link == "":
+                        student.link = link
+                        break
+                    # existing link same as in csv, nothing to do
+                    elif student.link == link:
+                        break
+                    # another link as in csv, let's keep it in case
+                    else:
+                        link_tmp = link
                 # csv link not found ? Let's take an existing one if not empty
                 else:
                     student.link = link_tmp
                 # share by link if empty string
-                if (not student.link):
-                    share_obj = self._cloud_client.share_file_with_link(
-                                                                folder_student)
-                    student.link = share_obj.get_link()
-                print(f"{display_counter} Folder"
-                      f' shared by link "{student.link}"')
-
-            # Shorten shared link if necessary and if it exists (max 5 tries)
-            if (shorten_link) and (student.link):
-                s = pyshorteners.Shortener()
-                for attempt in range(5):
-                    try:                  
-                        student.shortlink = s.tinyurl.short(student.link)
-                    except:
-                        pass
-                    else:
-                        print(f"{display_counter} Shared link"
-                              f' shortened as "{student.shortlink}"')
-                        break
+                try:
+                    if (not student.link):
+                        share_obj = self._remote_call(
+                                    "share_link",
+                                    self._cloud_client.share_file_with_link,
+                                    folder_student, idempotent=False)
+                        student.link = share_obj.get_link()
+                        shares["link"].append(student.link)
+                except Exception as e:
+                    log.append(f"ERROR: Folder {folder_student} couldn't be"
+                               f" shared by link\n{e}")
                 else:
-                    print(f"ERROR: Link couldn't be shortened")
+                    journal.record(student.number, "link", student.link)
+                    log.append(f"{display_counter} Folder"
+                               f' shared by link "{student.link}"')
 
-        if share_by_link:
-            self._write_links_to_csv(replace_csv=replace_csv)
+            # Shorten shared link if necessary and if it exists
+            if (shorten_link) and (student.link) and (
+                    not journal.done(student.number, "shortlink")):
+                try:
+                    student.shortlink = self._shortener.short(student.link)
+                except Exception as e:
+                    log.append(f"ERROR: Link couldn't be shortened\n{e}")
+                else:
+                    journal.record(student.number, "shortlink",
+                                   student.shortlink)
+                    log.append(f"{display_counter} Shared link"
+                               f' shortened as "{student.shortlink}"')
+        except Exception as e:
+            log.append(f"ERROR: Student {student.number} couldn't be"
+                       f" processed\n{e}")
+        finally:
+            with self._print_lock:
+                print("\n".join(log))
+                if any(line.startswith("ERROR") for line in log):
+                    self._failed_students.append(student)
+
+    def _write_links_to_csv(self, replace_csv=False, quiet=False):
+        """Save links to .csv (timed as "csv write" phase)"""
+        with self._metrics.phase("csv write"):
+            self._write_links_to_csv_file(replace_csv=replace_csv,
+                                          quiet=quiet)
 
-    def _write_links_to_csv(self, replace_csv=False):
+    def _write_links_to_csv_file(self, replace_csv=False, quiet=False):
+        """Save links to .csv in a single streaming pass.
+
+        Comment lines, column order and unnamed columns are kept, "link" and
+        "shortlink" columns are added (if not there) after named columns.
+        Rows of unknown students are left unchanged. The new file is written
+        to a temporary file then renamed, so it is never half written.
+        Without replace_csv, a new .csv file is created once per run.
+        """
         # Get .csv file details from _csvfile attribute
         csv_filepath = self._csvfile["csv_filepath"]
         csv_delimiter = self._csvfile["csv_delimiter"]
@@ -422,64 +2229,74 @@ class AMCtoOwncloud:
         link_header = self._csvfile["link_header"]
         shortlink_header = self._csvfile["shortlink_header"]
 
-        # New temporary .csv file path
-        new_filename = (Path(csv_filepath).stem + "-" +
-                        datetime.datetime.now().isoformat(timespec="minutes") +
-                        ".csv")
-        new_filepath = Path(csv_filepath).with_name(new_filename)
-        # Save links to the new temporary .csv file
+        # New .csv file path (same file during a run)
+        if replace_csv:
+            new_filepath = Path(csv_filepath)
+        else:
+            new_filepath = self._csvfile.get("new_filepath")
+        if new_filepath is None:
+            new_filename = (Path(csv_filepath).stem + "-" +
+                            datetime.datetime.now().isoformat(
+                                                    timespec="minutes") +
+                            ".csv")
+            new_filepath = Path(csv_filepath).with_name(new_filename)
+            self._csvfile["new_filepath"] = new_filepath
+        tmp_filepath = new_filepath.with_name(new_filepath.name + ".tmp")
+
+        # Comment lines are put aside by the reader and written back
+        # just before the next row
+        comments = []
+
+        def data_lines(csv_in):
+            for line in csv_in:
+                if line.startswith(csv_comment):
+                    comments.append(line)
+                else:
+                    yield line
+
         with open(csv_filepath, 'r', newline="") as csv_in, \
-             open(new_filepath, 'w', newline="") as csv_out:
-            tab_in = csv.DictReader((row for row in csv_in
-                                     if not row.startswith(csv_comment)),
-                                    delimiter=csv_delimiter,
-                                    quoting=csv.QUOTE_MINIMAL)
-            # Remove empty fields in original file
-            tab_in.fieldnames = [i for i in tab_in.fieldnames if i]
-            # Add "link" header and "shortlink" header at the end (if not there)
-            fieldnames = tab_in.fieldnames.copy()
-            if link_header not in fieldnames:
-                fieldnames.append(link_header)
-            if shortlink_header not in fieldnames:
-                fieldnames.append(shortlink_header)
-            tab_out = csv.DictWriter(csv_out, fieldnames=fieldnames,
-                                     delimiter=csv_delimiter,
-                                     quoting=csv.QUOTE_MINIMAL)
-            tab_out.writeheader()
-            # Write file with link and shortlink if not present or different
-            # TODO: comment line starting with a '#' are lost in the process
+             open(tmp_filepath, 'w', newline="") as csv_out:
+            tab_in = csv.reader(data_lines(csv_in), delimiter=csv_delimiter)
+            tab_out = csv.writer(csv_out, delimiter=csv_delimiter,
+                                 quoting=csv.QUOTE_MINIMAL)
+            fieldnames = None
             for row in tab_in:
-                link = self._dict_of_students[row[number_header]].link
-                shortlink = self._dict_of_students[row[number_header]].shortlink
-                if row.get(link_header) != link:
-                    row[link_header] = link
-                if row.get(shortlink_header) != shortlink:
-                    row[shortlink_header] = shortlink
-                # Hack... If 2 or more unamed fields (stored in key None):
-                # temporarily create fieldnames to save them separately
-                # (and avoid quoting)
-                if isinstance(row.get(None), list):
-                    # remove the last empty fields
-                    while row[None] and (not (row[None])[-1]):
-                        del (row[None])[-1]
-                    # Create additional fields for unamed fields
-                    additional_fields = {"_Add" + str(i): new_field
-                                         for i, new_field
-                                         in enumerate(row.get(None))}
-                    row.update(additional_fields)
-                    tab_out.fieldnames.extend(additional_fields.keys())
-                    # Delete field None and save CSV row
-                    del row[None]
+                csv_out.writelines(comments)
+                comments.clear()
+                if not row:  # empty line
                     tab_out.writerow(row)
-                    # Remove additional fields and restore field None
-                    for i in range(len(additional_fields)):
-                        del tab_out.fieldnames[-1]
+                elif fieldnames is None:
+                    # Remove empty fields at the end of the header, then add
+                    # "link" and "shortlink" headers (if not there)
+                    while row and not row[-1]:
+                        del row[-1]
+                    nb_fields = len(row)
+                    fieldnames = row + [header for header
+                                        in (link_header, shortlink_header)
+                                        if header not in row]
+                    number_index = fieldnames.index(number_header)
+                    link_index = fieldnames.index(link_header)
+                    shortlink_index = fieldnames.index(shortlink_header)
+                    tab_out.writerow(fieldnames)
                 else:
-                    tab_out.writerow(row)
+                    # Unnamed fields (without the last empty ones) are
+                    # saved after the named ones
+                    unnamed_fields = row[nb_fields:]
+                    while unnamed_fields and not unnamed_fields[-1]:
+                        del unnamed_fields[-1]
+                    row = row[:nb_fields]
+                    row += [""] * (len(fieldnames) - len(row))
+                    student = self._dict_of_students.get(row[number_index])
+                    if student is not None:
+                        row[link_index] = student.link
+                        row[shortlink_index] = student.shortlink
+                    tab_out.writerow(row + unnamed_fields)
+            csv_out.writelines(comments)
+        os.replace(tmp_filepath, new_filepath)
 
-        # Replace the original .csv file if asked
+        if quiet:
+            return
         if replace_csv:
-            shutil.move(new_filepath, csv_filepath)
             print(f'Shared links saved to current .csv file "{csv_filepath}"')
         else:
             print(f'Shared links saved to new .csv file "{new_filepath}"')
@@ -491,9 +2308,50 @@ FOLDER = 'Quizzes/'
 FOLDER_SUFFIX = ' - Maths'
 ADDRESS = 'https://ncloud.zaclys.com'
 USERNAME = 'MyUserName'
+CREDENTIALS = None  # '~/.config/AMCtoOwncloud/credentials.json' to remember
+SMTP_HOST = 'smtp.example.com'  # to send links by e-mail (--send-emails)
+SMTP_USERNAME = 'MyUserName@example.com'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                description="Send AMC annotated papers to Owncloud/Nextcloud")
+    parser.add_argument("--force", action="store_true",
+                        help="send every paper again, even unchanged ones")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its journal")
+    parser.add_argument("--batch", metavar="CONFIG",
+                        help="run the jobs of a config file (see README)")
+    parser.add_argument("--letters", action="store_true",
+                        help="write information letters with QR codes"
+                             " (needs reportlab)")
+    parser.add_argument("--send-emails", action="store_true",
+                        help="e-mail their link to the students")
+    parser.add_argument("--compress", action="store_true",
+                        help="make .pdf papers smaller before upload"
+                             " (needs ghostscript)")
+    parser.add_argument("--metrics-json", metavar="PATH",
+                        help="save timings of the run as JSON")
+    parser.add_argument("--metrics-prometheus", metavar="PATH",
+                        help="save timings of the run as a Prometheus file")
+    args, _ = parser.parse_known_args()  # ignore files passed by Nautilus
 
-amcsend = AMCtoOwncloud()
-amcsend.identify_students(csv_filepath=CSV)
-amcsend.connect_owncloud(address=ADDRESS, username=USERNAME, SSO=False)
-amcsend.upload_and_share(folder_root=FOLDER, folder_name=FOLDER_SUFFIX, replace_csv=False,
-                         share_with_user=False, share_by_link=True, shorten_link=True)
+    if args.batch:
+        amcsend = AMCtoOwncloud(list_of_paths="")
+        amcsend.run_batch(args.batch, force=args.force, resume=args.resume)
+    else:
+        amcsend = AMCtoOwncloud()
+        amcsend.identify_students(csv_filepath=CSV)
+        amcsend.connect_owncloud(address=ADDRESS, username=USERNAME,
+                                 SSO=False, credentials_file=CREDENTIALS)
+        amcsend.upload_and_share(folder_root=FOLDER,
+                                 folder_name=FOLDER_SUFFIX,
+                                 replace_csv=False, share_with_user=False,
+                                 share_by_link=True, shorten_link=True,
+                                 force=args.force, resume=args.resume,
+                                 compress=args.compress)
+        if args.letters:
+            amcsend.write_letters()
+        if args.send_emails:
+            amcsend.send_emails(SMTP_HOST, username=SMTP_USERNAME)
+    amcsend.report_metrics(json_filepath=args.metrics_json,
+                           prometheus_filepath=args.metrics_prometheus)
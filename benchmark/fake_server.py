@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Local stand-in for Owncloud/Nextcloud and tinyurl.com, to benchmark
+# AMCtoOwncloud without a real server
+# Copyright (C) 2017-2018 Rémi GROLLEAU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+from xml.sax.saxutils import escape
+
+
+OCS_SHARES = "/ocs/v1.php/apps/files_sharing/api/v1/shares"
+
+
+class FakeCloudServer:
+    """FakeCloudServer object"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle=None,
+                 max_depth=None, host="127.0.0.1", port=0):
+        """Serve the requests used by AMCtoOwncloud (pyocclient) in a thread.
+
+        - OCS: capabilities, shares (GET, POST), core/getapppassword
+        - WebDAV: PROPFIND (Depth 0, 1, infinity), MKCOL, PUT, MOVE, DELETE
+        on remote.php/webdav and remote.php/dav (files and chunked uploads)
+        - Shortener: /api-create.php?url=... (same API as tinyurl.com)
+
+        Every request waits latency seconds, fails with a 500 error with
+        probability error_rate, and gets a 429 (Retry-After: 1) answer when
+        more than throttle requests are received in the same second.
+        With max_depth=1, PROPFIND Depth: infinity is silently answered
+        with depth 1 (like servers without infinite depth enabled).
+        Any username/password is accepted. File contents are not kept.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.max_depth = max_depth
+        self.requests = Counter()  # key = kind of request
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._window = (0, 0)  # (second, number of requests)
+        self._random = random.Random(0)
+        self.reset()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def reset(self):
+        """Empty the remote tree and remove every share"""
+        with self._lock:
+            self.folders = {"/": uuid.uuid4().hex}  # key = path, value = etag
+            self.files = {}  # key = path, value = (size, etag, mtime)
+            self.uploads = {}  # key = upload id, value = {chunk: size}
+            self.shares = []
+            self.shortlinks = {}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, kind, nbytes=0):
+        with self._lock:
+            self.requests[kind] += 1
+            self.bytes_received += nbytes
+
+    def back_pressure(self):
+        """Return the error status to send (429, 500) or None"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.throttle:
+                second = int(time.monotonic())
+                start, count = self._window
+                count = count + 1 if start == second else 1
+                self._window = (second, count)
+                if count > self.throttle:
+                    return 429
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 500
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Request handler of FakeCloudServer"""
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    # Helpers
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status, body=b"", content_type="text/plain",
+              headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_ocs(self, data="", statuscode=100):
+        self._send(200, f'<?xml version="1.0"?>\n<ocs><meta>'
+                        f'<status>{"ok" if statuscode == 100 else "failure"}'
+                        f'</status><statuscode>{statuscode}</statuscode>'
+                        f'<message/></meta><data>{data}</data></ocs>',
+                   content_type="text/xml; charset=utf-8")
+
+    def _handle(self, method):
+        url = parse.urlsplit(self.path)
+        body = self._read_body()
+        kind = self._kind(method, url.path)
+        self.fake.count(kind, len(body))
+        status = self.fake.back_pressure()
+        if status == 429:
+            return self._send(429, "Too many requests",
+                              headers={"Retry-After": "1"})
+        if status:
+            return self._send(status, "Internal error")
+        if url.path == "/api-create.php":
+            return self._shorten(parse.parse_qs(url.query))
+        if url.path.startswith("/ocs/"):
+            return self._ocs(method, url, body)
+        dav = self._dav_path(url.path)
+        if dav is None:
+            return self._send(404, "Not found")
+        prefix, path = dav
+        with self.fake._lock:
+            return getattr(self, f"_dav_{method.lower()}")(prefix, path, body)
+
+    def _kind(self, method, path):
+        if path == "/api-create.php":
+            return "shorten"
+        if path.startswith("/ocs/"):
+            return f"OCS {method} {path.rsplit('/', 1)[-1]}"
+        if "/remote.php/dav/uploads/" in path:
+            return f"{method} (chunked)"
+        return method
+
+    @staticmethod
+    def _dav_path(path):
+        """Return (href prefix, remote path) of a WebDAV url path"""
+        path = parse.unquote(path)
+        for prefix in ("/remote.php/webdav",):
+            if path.startswith(prefix):
+                return prefix, "/" + path[len(prefix):].strip("/")
+        for endpoint in ("/remote.php/dav/files/", "/remote.php/dav/uploads/"):
+            if path.startswith(endpoint):
+                user, _, rest = path[len(endpoint):].partition("/")
+                return endpoint + user, "/" + rest.strip("/")
+        return None
+
+    # Shortener
+
+    def _shorten(self, query):
+        link = query.get("url", [""])[0]
+        if not link:
+            return self._send(400, "Error")
+        with self.fake._lock:
+            shortlink = self.fake.shortlinks.setdefault(
+                link, f"{self.fake.url}t/{len(self.fake.shortlinks) + 1}")
+        self._send(200, shortlink)
+
+    # OCS
+
+    def _ocs(self, method, url, body):
+        if url.path.endswith("/cloud/capabilities"):
+            return self._send_ocs(
+                "<version><major>25</major><minor>0</minor><micro>0</micro>"
+                "<string>25.0.0</string><edition/></version>"
+                "<capabilities><core><pollinterval>60</pollinterval>"
+                "</core></capabilities>")
+        if url.path.endswith("/core/getapppassword"):
+            return self._send_ocs(
+                f"<apppassword>{uuid.uuid4().hex}</apppassword>")
+        if url.path == OCS_SHARES and method == "GET":
+            query = parse.parse_qs(url.query)
+            path = query.get("path", [None])[0]
+            with self.fake._lock:
+                shares = [share for share in self.fake.shares
+                          if path is None
+                          or share["path"] == "/" + path.strip("/")]
+                return self._send_ocs("".join(self._share_xml(share)
+                                              for share in shares))
+        if url.path == OCS_SHARES and method == "POST":
+            form = parse.parse_qs(body.decode("utf-8"))
+            path = "/" + form["path"][0].strip("/")
+            with self.fake._lock:
+                if path not in self.fake.folders and (
+                        path not in self.fake.files):
+                    return self._send_ocs(statuscode=404)
+                share = {"id": len(self.fake.shares) + 1,
+                         "share_type": int(form["shareType"][0]),
+                         "path": path,
+                         "share_with": form.get("shareWith", [""])[0],
+                         "token": uuid.uuid4().hex[:15]}
+                if share["share_type"] == 3:
+                    share["url"] = f"{self.fake.url}s/{share['token']}"
+                self.fake.shares.append(share)
+            return self._send_ocs(self._share_xml(share, element=False))
+        self._send(404, "Not found")
+
+    @staticmethod
+    def _share_xml(share, element=True):
+        xml = "".join(f"<{key}>{escape(str(value))}</{key}>"
+                      for key, value in share.items())
+        xml += "<name/>"
+        return f"<element>{xml}</element>" if element else xml
+
+    # WebDAV (called with the fake server lock held)
+
+    def _dav_propfind(self, prefix, path, body):
+        fake = self.fake
+        if path not in fake.folders and path not in fake.files:
+            return self._send(404, "Not found")
+        depth = self.headers.get("Depth", "infinity")
+        if depth == "infinity" and fake.max_depth is not None:
+            depth = str(fake.max_depth)
+        paths = [path]
+        if path in fake.folders and depth != "0":
+            base = "" if path == "/" else path
+            for child in list(fake.folders) + list(fake.files):
+                rest = child[len(base):]
+                if child != path and child.startswith(base + "/") and (
+                        depth == "infinity" or "/" not in rest[1:]):
+                    paths.append(child)
+        responses = []
+        for child in paths:
+            href = parse.quote(prefix + child)
+            if child in fake.folders:
+                href = href.rstrip("/") + "/"
+                prop = (f"<d:getetag>\"{fake.folders[child]}\"</d:getetag>"
+                        f"<d:resourcetype><d:collection/></d:resourcetype>")
+            else:
+                size, etag, mtime = fake.files[child]
+                prop = (f"<d:getetag>\"{etag}\"</d:getetag>"
+                        f"<d:getcontentlength>{size}</d:getcontentlength>"
+                        f"<d:getlastmodified>{formatdate(mtime, usegmt=True)}"
+                        f"</d:getlastmodified><d:resourcetype/>")
+            responses.append(f"<d:response><d:href>{href}</d:href>"
+                             f"<d:propstat><d:prop>{prop}</d:prop>"
+                             f"<d:status>HTTP/1.1 200 OK</d:status>"
+                             f"</d:propstat></d:response>")
+        self._send(207, '<?xml version="1.0"?>\n<d:multistatus'
+                        ' xmlns:d="DAV:">' + "".join(responses) +
+                        "</d:multistatus>",
+                   content_type="application/xml; charset=utf-8")
+
+    def _dav_mkcol(self, prefix, path, body):
+        fake = self.fake
+        if "/uploads/" in prefix:
+            fake.uploads[path] = {}
+            return self._send(201)
+        if path in fake.folders or path in fake.files:
+            return self._send(405, "Already exists")
+        parent = path.rsplit("/", 1)[0] or "/"
+        if parent not in fake.folders:
+            return self._send(409, "Parent missing")
+        fake.folders[path] = uuid.uuid4().hex
+        self._send(201)
+
+    def _dav_put(self, prefix, path, body):
+        fake = self.fake
+        if "/uploads/" in prefix:
+            upload, _, chunk = path.rpartition("/")
+            if upload not in fake.uploads:
+                return self._send(404, "Upload missing")
+            fake.uploads[upload][chunk] = len(body)
+            return self._send(201)
+        parent = path.rsplit("/", 1)[0] or "/"
+        if parent not in fake.folders:
+            return self._send(409, "Parent missing")
+        status = 204 if path in fake.files else 201
+        etag = uuid.uuid4().hex
+        fake.files[path] = (len(body), etag, time.time())
+        self._send(status, headers={"ETag": f'"{etag}"',
+                                    "OC-ETag": f'"{etag}"'})
+
+    def _dav_move(self, prefix, path, body):
+        fake = self.fake
+        upload = path.rsplit("/", 1)[0]
+        if "/uploads/" not in prefix or upload not in fake.uploads:
+            return self._send(501, "Only chunked uploads can be moved")
+        destination = self._dav_path(
+                        parse.urlsplit(self.headers["Destination"]).path)[1]
+        parent = destination.rsplit("/", 1)[0] or "/"
+        if parent not in fake.folders:
+            return self._send(409, "Parent missing")
+        size = sum(fake.uploads.pop(upload).values())
+        status = 204 if destination in fake.files else 201
+        etag = uuid.uuid4().hex
+        fake.files[destination] = (size, etag, time.time())
+        self._send(status, headers={"ETag": f'"{etag}"',
+                                    "OC-ETag": f'"{etag}"'})
+
+    def _dav_delete(self, prefix, path, body):
+        fake = self.fake
+        fake.uploads.pop(path, None)
+        fake.files.pop(path, None)
+        fake.folders.pop(path, None)
+        self._send(204)
+
+    # HTTP methods
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def do_MKCOL(self):
+        self._handle("MKCOL")
+
+    def do_MOVE(self):
+        self._handle("MOVE")
+
+    def do_PROPFIND(self):
+        self._handle("PROPFIND")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+                description="Fake Owncloud/Nextcloud server and shortener")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle", type=int, default=None)
+    args = parser.parse_args()
+    server = FakeCloudServer(latency=args.latency, error_rate=args.error_rate,
+                             throttle=args.throttle, port=args.port)
+    print(f"Fake Owncloud/Nextcloud and shortener at {server.url}")
+    server.start()
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Benchmark of AMCtoOwncloud against a local stand-in server
+# Copyright (C) 2017-2018 Rémi GROLLEAU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from fake_server import FakeCloudServer
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+
+
+def load_amctoowncloud():
+    """Import .AMCtoOwncloud.py (not importable by name, it starts with .)"""
+    spec = importlib.util.spec_from_file_location(
+                "AMCtoOwncloud", REPOSITORY / ".AMCtoOwncloud.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_students(folder, nb_students, paper_size, nb_groups=8):
+    """Create students.csv and one paper per student in folder/papers.
+
+    Return the paths of the .csv file and of the papers folder.
+    """
+    papers = Path(folder, "papers")
+    papers.mkdir()
+    csv_filepath = Path(folder, "students.csv")
+    with open(csv_filepath, "w") as csv_file:
+        csv_file.write("group;surname;name;id;owncloud;email\n")
+        for i in range(nb_students):
+            number = 10000 + i
+            csv_file.write(f"G{i % nb_groups};SURNAME{i};Name{i};{number};"
+                           f"user{i};user{i}@example.com\n")
+            with open(papers / f"Quiz-{number}.pdf", "wb") as paper:
+                paper.write(os.urandom(paper_size))
+    return csv_filepath, papers
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", str(REPOSITORY), "rev-parse",
+                               "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(amc, server, csv_filepath, papers, workers, verbose=False):
+    """One run of identify_students/connect_owncloud/upload_and_share.
+
+    Return wall time, requests and bytes received by the server.
+    """
+    requests_before = sum(server.requests.values())
+    bytes_before = server.bytes_received
+    output = io.StringIO()
+    start = time.perf_counter()
+    with (contextlib.nullcontext() if verbose
+          else contextlib.redirect_stdout(output)):
+        amcsend = amc.AMCtoOwncloud(list_of_paths=str(papers))
+        amcsend.identify_students(csv_filepath=str(csv_filepath))
+        amcsend.connect_owncloud(address=server.url, username="benchmark",
+                                 password="benchmark", pool_size=workers)
+        amcsend.upload_and_share(folder_root="Quizzes/",
+                                 quiz_name="Benchmark",
+                                 replace_csv=True,
+                                 max_workers=workers,
+                                 shortener_url=server.url + "api-create.php",
+                                 shortener_rate=1000)
+    return {"seconds": time.perf_counter() - start,
+            "requests": sum(server.requests.values()) - requests_before,
+            "bytes": server.bytes_received - bytes_before,
+            "metrics": amcsend._metrics.as_dict(),
+            "connections": amcsend.connection_stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description="Benchmark AMCtoOwncloud.upload_and_share"
+                            " against a local fake Owncloud/Nextcloud")
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--paper-size", type=int, default=200_000,
+                        help="size of each paper in bytes")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--reruns", type=int, default=1,
+                        help="number of runs after the cold run")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="server latency in seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle", type=int, default=None,
+                        help="max requests per second before 429 errors")
+    parser.add_argument("--max-depth", type=int, default=None,
+                        help="answer PROPFIND Depth: infinity with this depth")
+    parser.add_argument("--json", metavar="PATH",
+                        help="save results to compare between commits")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the script output")
+    args = parser.parse_args()
+
+    amc = load_amctoowncloud()
+    results = {"revision": git_revision(),
+               "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "parameters": {key: value for key, value in vars(args).items()
+                              if key not in ("json", "verbose")},
+               "runs": []}
+    with tempfile.TemporaryDirectory() as folder, \
+         FakeCloudServer(latency=args.latency, error_rate=args.error_rate,
+                         throttle=args.throttle,
+                         max_depth=args.max_depth) as server:
+        csv_filepath, papers = generate_students(folder, args.students,
+                                                 args.paper_size)
+        print(f"{'Run':8} {'Seconds':>8} {'Requests':>9} {'Req/student':>11}"
+              f" {'Students/s':>10} {'MB/s':>7}")
+        for i in range(1 + args.reruns):
+            result = run(amc, server, csv_filepath, papers, args.workers,
+                         verbose=args.verbose)
+            result["run"] = "cold" if i == 0 else f"rerun {i}"
+            results["runs"].append(result)
+            print(f"{result['run']:8} {result['seconds']:8.2f}"
+                  f" {result['requests']:9d}"
+                  f" {result['requests'] / args.students:11.1f}"
+                  f" {args.students / result['seconds']:10.1f}"
+                  f" {result['bytes'] / 1e6 / result['seconds']:7.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f'Results saved to "{args.json}"')
+
+
+if __name__ == "__main__":
+    main()
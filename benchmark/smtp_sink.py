@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Local SMTP sink to try AMCtoOwncloud e-mail delivery without sending mails
+# Copyright (C) 2017-2018 Rémi GROLLEAU
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import email
+import email.policy
+import socketserver
+import threading
+
+
+class SmtpSink:
+    """SmtpSink object"""
+
+    def __init__(self, host="127.0.0.1", port=0, verbose=False):
+        """Accept and keep every message sent by SMTP, in a thread.
+
+        Plain SMTP only (no STARTTLS), any AUTH is accepted.
+        messages is a list of (sender, recipients, email.message objects),
+        connections is the number of SMTP sessions opened.
+        """
+        self.verbose = verbose
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer((host, port),
+                                                       _Handler)
+        self._server.daemon_threads = True
+        self._server.sink = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def receive(self, sender, recipients, data):
+        message = email.message_from_bytes(data, policy=email.policy.default)
+        with self._lock:
+            self.messages.append((sender, recipients, message))
+        if self.verbose:
+            print(f"{sender} -> {', '.join(recipients)}:"
+                  f" {message['Subject']}")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """SMTP session of SmtpSink"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+        with sink._lock:
+            sink.connections += 1
+        self.reply("220 localhost SMTP sink")
+        sender, recipients = None, []
+        for line in self.rfile:
+            command = line.decode(errors="replace").strip()
+            verb = command[:4].upper()
+            if verb == "EHLO":
+                self.reply("250-localhost")
+                self.reply("250-AUTH PLAIN")
+                self.reply("250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 localhost")
+            elif verb == "AUTH":
+                self.reply("235 Authentication successful")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip("<> "), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip("<> "))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    if data_line.startswith(b".."):
+                        data_line = data_line[1:]
+                    lines.append(data_line)
+                sink.receive(sender, recipients, b"".join(lines))
+                self.reply("250 OK")
+            elif verb == "RSET":
+                sender, recipients = None, []
+                self.reply("250 OK")
+            elif verb == "NOOP":
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+                description="Local SMTP sink printing received messages")
+    parser.add_argument("--port", type=int, default=1025)
+    args = parser.parse_args()
+    sink = SmtpSink(port=args.port, verbose=True)
+    print("SMTP sink at {}:{}".format(*sink.address))
+    sink.start()
+    try:
+        sink._thread.join()
+    except KeyboardInterrupt:
+        sink.stop()